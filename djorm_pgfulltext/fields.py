@@ -7,29 +7,144 @@ except NameError:
     basestring = str
 
 import django
-from django.db import models
+from django.db import connections, models
+try:
+    from django.db.backends.utils import truncate_name
+except ImportError:
+    from django.db.backends.util import truncate_name
+from psycopg2.extensions import AsIs
 
-from djorm_pgfulltext.utils import adapt
+from djorm_pgfulltext.utils import adapt, get_normalized_tsquery, get_tsquery_cache_size
 
 
 class VectorField(models.Field):
+    """
+    A tsvector column.
+
+    With generated=True (PostgreSQL >= 12), the column is a stored generated
+    column computed by the database from the fields, weights and config of
+    the model's search manager, whose search_field must be this field, so
+    it never has to be updated from Django.
+
+    The field also declares its text search index: index_type is 'gin' (the
+    default), 'gist' or 'rum' (needs the rum extension, and lets
+    SearchQuerySet.search_top read rows in rank order), and GIN indexes accept
+    the fastupdate and gin_pending_list_limit storage parameters. The index is
+    built by the CreateSearchIndex migration operation, see:
+
+    http://www.postgresql.org/docs/9.4/static/textsearch-indexes.html
+    https://github.com/postgrespro/rum
+    """
+
+    INDEX_TYPES = ('gin', 'gist', 'rum')
 
     def __init__(self, *args, **kwargs):
-        kwargs['default'] = ''
+        self.index_type = kwargs.pop('index_type', 'gin')
+        self.fastupdate = kwargs.pop('fastupdate', None)
+        self.gin_pending_list_limit = kwargs.pop('gin_pending_list_limit', None)
+
+        if self.index_type not in self.INDEX_TYPES:
+            raise ValueError("index_type must be one of: %s" % ", ".join(self.INDEX_TYPES))
+        if self.index_type != 'gin' and (self.fastupdate is not None or self.gin_pending_list_limit is not None):
+            raise ValueError("fastupdate and gin_pending_list_limit are only supported by gin indexes")
+
+        self.generated = kwargs.pop('generated', False)
+        if not self.generated:
+            # Generated columns cannot have a default.
+            kwargs['default'] = ''
         kwargs['editable'] = False
         kwargs['serialize'] = False
         super(VectorField, self).__init__(*args, **kwargs)
 
     def deconstruct(self):
         name, path, args, kwargs = super(VectorField, self).deconstruct()
-        del kwargs['default']
+        kwargs.pop('default', None)
         del kwargs['editable']
         del kwargs['serialize']
+        if self.generated:
+            kwargs['generated'] = True
+        if self.index_type != 'gin':
+            kwargs['index_type'] = self.index_type
+        if self.fastupdate is not None:
+            kwargs['fastupdate'] = self.fastupdate
+        if self.gin_pending_list_limit is not None:
+            kwargs['gin_pending_list_limit'] = self.gin_pending_list_limit
         return name, path, args, kwargs
 
-    def db_type(self, *args, **kwargs):
+    def db_type(self, connection):
+        if self.generated:
+            return 'tsvector GENERATED ALWAYS AS (%s) STORED' % self.get_generation_expression(connection)
         return 'tsvector'
 
+    def get_search_index_name(self, connection):
+        return connection.ops.quote_name(truncate_name(
+            "%s_%s_%s" % (self.model._meta.db_table, self.column, self.index_type),
+            connection.ops.max_name_length()
+        ))
+
+    def get_search_index_sql(self, connection, concurrently=False):
+        """
+        Return the statement creating the text search index of this field.
+        """
+        options = []
+        if self.fastupdate is not None:
+            options.append("fastupdate = %s" % ('on' if self.fastupdate else 'off'))
+        if self.gin_pending_list_limit is not None:
+            options.append("gin_pending_list_limit = %d" % self.gin_pending_list_limit)
+
+        return "CREATE INDEX %s%s ON %s USING %s (%s)%s;" % (
+            "CONCURRENTLY " if concurrently else "",
+            self.get_search_index_name(connection),
+            connection.ops.quote_name(self.model._meta.db_table),
+            self.index_type,
+            connection.ops.quote_name(self.column),
+            " WITH (%s)" % ", ".join(options) if options else ""
+        )
+
+    def get_drop_search_index_sql(self, connection, concurrently=False):
+        return "DROP INDEX %sIF EXISTS %s;" % (
+            "CONCURRENTLY " if concurrently else "",
+            self.get_search_index_name(connection)
+        )
+
+    def get_search_manager(self):
+        manager = getattr(self.model, '_fts_manager', None)
+        if manager is None and django.VERSION >= (1, 7):
+            # Models of migration states have no custom managers, use the current model.
+            from django.apps import apps
+            model = apps.get_model(self.model._meta.app_label, self.model._meta.object_name)
+            manager = getattr(model, '_fts_manager', None)
+
+        if manager is None or manager.search_field != self.name:
+            raise ValueError("%s.%s is not the search_field of a search manager" % (
+                self.model._meta.object_name, self.name
+            ))
+        return manager
+
+    def get_generation_expression(self, connection):
+        manager = self.get_search_manager()
+        search_vector = manager._get_search_vector(manager.config, connection.alias) or "''"
+
+        # The columns of a generation expression cannot be qualified.
+        return search_vector.replace("%s." % connection.ops.quote_name(manager.model._meta.db_table), "")
+
+    def pre_save(self, model_instance, add):
+        if self.generated:
+            return AsIs('DEFAULT')
+
+        manager = getattr(model_instance, '_fts_manager', None)
+        if manager is not None and manager.auto_update_search_field and manager.search_field == self.attname:
+            if manager._can_update_inline() and (add or manager._search_fields_changed(model_instance)):
+                return manager._get_inline_search_vector(model_instance)
+
+            if not add:
+                # The vector is maintained by the manager and the value of the
+                # instance may be stale, so an UPDATE keeps the stored one.
+                connection = connections[model_instance._state.db or manager.db]
+                return AsIs(connection.ops.quote_name(self.column))
+
+        return super(VectorField, self).pre_save(model_instance, add)
+
     # def get_prep_lookup(self, lookup_type, value):
     #     if hasattr(value, 'prepare'):
     #         return value.prepare()
@@ -78,16 +193,24 @@ if django.VERSION >= (1, 7):
                 rhs_params = [rhs_params]
 
             if type(rhs_params[0]) == TSConfig:
-                ts = rhs_params[0]
-                ts_name = ts.name
-                cmd = '%s @@ to_tsquery(%%s::regconfig, %%s)' % lhs
-
-                rest = (ts_name, " & ".join(self.transform.__call__(rhs_params[1:])))
+                ts_name = rhs_params[0].name
+                words = rhs_params[1:]
             else:
-                cmd = '%s @@ to_tsquery(%%s)' % lhs
-                rest = (" & ".join(self.transform.__call__(rhs_params)),)
-
-            return cmd, rest
+                ts_name = None
+                words = rhs_params
+
+            if get_tsquery_cache_size():
+                # Reuse the tsquery already parsed for the same words, found
+                # before they are quoted again.
+                tsquery = get_normalized_tsquery(
+                    'to_tsquery', ts_name, lambda: " & ".join(self.transform(words)), connection.alias,
+                    key=(self.lookup_name,) + tuple(words)
+                )
+                return '%s @@ %%s::tsquery' % lhs, (tsquery,)
+
+            if ts_name is not None:
+                return '%s @@ to_tsquery(%%s::regconfig, %%s)' % lhs, (ts_name, " & ".join(self.transform(words)))
+            return '%s @@ to_tsquery(%%s)' % lhs, (" & ".join(self.transform(words)),)
 
     class FullTextLookup(FullTextLookupBase):
         """This lookup scans for exact matches in the full text index.
@@ -0,0 +1,43 @@
+"""
+Create search field triggers.
+"""
+from __future__ import print_function
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from djorm_pgfulltext.management.commands.update_search_field import get_search_models
+
+
+class Command(BaseCommand):
+    help = 'Create triggers keeping search fields up to date'
+    args = "appname [model]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--drop', action='store_true', dest='drop', default=False,
+                    help='Drop the triggers instead of creating them.'),
+        make_option('--print', action='store_true', dest='print_sql', default=False,
+                    help='Print the SQL statements instead of running them.'),
+    )
+
+    def handle(self, app=None, model=None, **options):
+        if not app:
+            raise CommandError("You must provide an app to create search triggers.")
+
+        for m in get_search_models(app, model):
+            manager = m._fts_manager
+            if options.get('drop'):
+                statements = manager.get_drop_search_trigger_sql()
+            else:
+                statements = manager.get_search_trigger_sql()
+
+            if options.get('print_sql'):
+                print("\n".join(statements))
+                continue
+
+            print("Processing model %s..." % m, end='')
+            cursor = connections[manager.db].cursor()
+            for sql in statements:
+                cursor.execute(sql)
+            print("Done")
@@ -2,49 +2,428 @@
 Update search fields.
 """
 from __future__ import print_function
+from datetime import timedelta
+from optparse import make_option
+import threading
+import time
+
 from django.core.management.base import BaseCommand, CommandError
-from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import models, connections
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.encoding import smart_text
+
+
+def get_search_models(app, model=None):
+    """
+    Return the models of `app`, or only `model`, having a search manager.
+    """
+
+    # check application
+
+    try:
+        app_module = models.get_app(app)
+    except ImproperlyConfigured:
+        raise CommandError("There is no enabled application matching '%s'." % app)
+
+    app_models = []
+
+    # get models
+
+    if model:
+        m = models.get_model(app, model)
+        if not m:
+            raise CommandError("There is no model '%s'." % model)
+
+        app_models.append(m)
+    else:
+        app_models += models.get_models(app_module)
+
+    # get models only with search managers
+
+    app_models_for_process = [x for x in app_models if getattr(x, '_fts_manager', None)]
+
+    if not app_models_for_process:
+        raise CommandError("There is no models for processing.")
+
+    return app_models_for_process
+
+
+class Checkpoint(object):
+    """
+    The progress of the update of the search field of a model, or of one
+    part of it (a pk range, when running workers), saved after each batch in
+    the djorm_pgfulltext_reindex table, so an interrupted update can be
+    resumed and long ones can be followed from the database.
+    """
+
+    table = 'djorm_pgfulltext_reindex'
+
+    def __init__(self, model, part='', using=None):
+        self.manager = model._fts_manager
+        self.using = using or self.manager.db
+        self.key = [model._meta.db_table, self.manager.search_field, part]
+        self.pk_range = (None, None)
+        self.last_pk = None
+        self.rows = 0
+        self.finished = False
+
+    @classmethod
+    def create_table(cls, using):
+        connections[using].cursor().execute(
+            "CREATE TABLE IF NOT EXISTS %s ("
+            "model varchar(255) NOT NULL, "
+            "search_field varchar(255) NOT NULL, "
+            "part varchar(32) NOT NULL, "
+            "range_first text, "
+            "range_last text, "
+            "range_last_included boolean NOT NULL DEFAULT true, "
+            "last_pk text, "
+            "rows bigint NOT NULL DEFAULT 0, "
+            "rows_per_second double precision, "
+            "started_at timestamp with time zone NOT NULL DEFAULT now(), "
+            "updated_at timestamp with time zone, "
+            "finished_at timestamp with time zone, "
+            "PRIMARY KEY (model, search_field, part))" % connections[using].ops.quote_name(cls.table)
+        )
+
+    @classmethod
+    def load_parts(cls, model, using=None):
+        """
+        Return the saved checkpoints of the parts of the last update of
+        `model` made by workers, ordered by part.
+        """
+        manager = model._fts_manager
+        using = using or manager.db
+        cursor = connections[using].cursor()
+        cursor.execute(
+            "SELECT part FROM %s WHERE model = %%s AND search_field = %%s AND part <> ''" % (
+                connections[using].ops.quote_name(cls.table)
+            ),
+            [model._meta.db_table, manager.search_field]
+        )
+
+        checkpoints = []
+        for part, in sorted(cursor.fetchall(), key=lambda x: int(x[0].split('/')[0])):
+            checkpoint = cls(model, part, using)
+            checkpoint.load()
+            checkpoints.append(checkpoint)
+        return checkpoints
+
+    @classmethod
+    def clear_parts(cls, model, using=None):
+        """
+        Remove the saved checkpoints of the parts of the updates of `model`.
+        """
+        manager = model._fts_manager
+        using = using or manager.db
+        connections[using].cursor().execute(
+            "DELETE FROM %s WHERE model = %%s AND search_field = %%s AND part <> ''" % (
+                connections[using].ops.quote_name(cls.table)
+            ),
+            [model._meta.db_table, manager.search_field]
+        )
+
+    def execute(self, sql, params=()):
+        cursor = connections[self.using].cursor()
+        cursor.execute(sql % {'table': connections[self.using].ops.quote_name(self.table)},
+                       list(params) + self.key)
+        return cursor
+
+    def load(self):
+        """
+        Read the saved checkpoint, and return True if there is one.
+        """
+        cursor = self.execute(
+            "SELECT range_first, range_last, range_last_included, last_pk, rows, finished_at IS NOT NULL "
+            "FROM %(table)s "
+            "WHERE model = %%s AND search_field = %%s AND part = %%s"
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return False
+
+        to_python = self.manager.model._meta.pk.to_python
+        first, last, last_included, last_pk, self.rows, self.finished = row
+        self.pk_range = tuple(None if x is None else to_python(x) for x in (first, last))
+        if not last_included:
+            self.pk_range += (False,)
+        self.last_pk = None if last_pk is None else to_python(last_pk)
+        return True
+
+    def start(self, pk_range=(None, None)):
+        self.pk_range = pk_range
+        self.last_pk = None
+        self.rows = 0
+        self.finished = False
+        self.execute("DELETE FROM %(table)s WHERE model = %%s AND search_field = %%s AND part = %%s")
+        self.execute(
+            "INSERT INTO %(table)s (range_first, range_last, range_last_included, model, search_field, part) "
+            "VALUES (%%s, %%s, %%s, %%s, %%s, %%s)",
+            [None if x is None else smart_text(x) for x in pk_range[:2]] + [pk_range[2:3] in ((), (True,))]
+        )
+
+    def get_resume_range(self):
+        """
+        Return the pk range left to update: the keys after the last updated
+        one, which is left out so it is not counted twice.
+        """
+        if self.last_pk is None:
+            return self.pk_range
+        return (self.last_pk, self.pk_range[1], self.pk_range[2:3] in ((), (True,)), False)
+
+    def save(self, rows, last_pk, rows_per_second):
+        self.execute(
+            "UPDATE %(table)s SET rows = %%s, last_pk = %%s, rows_per_second = %%s, updated_at = now() "
+            "WHERE model = %%s AND search_field = %%s AND part = %%s",
+            [rows, smart_text(last_pk), rows_per_second]
+        )
+
+    def finish(self):
+        self.execute(
+            "UPDATE %(table)s SET finished_at = now() WHERE model = %%s AND search_field = %%s AND part = %%s"
+        )
+
+
+def parse_since(value):
+    """
+    Parse the --since option, a date or a datetime in ISO 8601 format.
+    """
+    try:
+        since = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        since = None
+    if since is None:
+        raise CommandError("--since must be a date or a datetime, such as 2016-01-31 or 2016-01-31T12:00.")
+    return since
+
+
+def get_estimated_rows(model, using):
+    """
+    Return the number of rows of the table of `model` estimated by
+    PostgreSQL, or None if the table has never been analyzed.
+    """
+    cursor = connections[using].cursor()
+    cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                   [connections[using].ops.quote_name(model._meta.db_table)])
+    rows = cursor.fetchone()[0]
+    return int(rows) if rows > 0 else None
 
 
 class Command(BaseCommand):
     help = 'Update search fields'
     args = "appname [model]"
 
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+                    help='Update rows in batches of this size, each one in its own transaction.'),
+        make_option('--sleep', dest='sleep_between', type='float', default=None,
+                    help='Seconds to sleep between two batches.'),
+        make_option('--only-changed', action='store_true', dest='only_changed', default=False,
+                    help='Only write rows whose search vector actually changes.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help='Split each table in this many pk ranges and update them concurrently, '
+                         'each one on its own database connection.'),
+        make_option('--staged', action='store_true', dest='staged', default=False,
+                    help='Compute the vectors into an unlogged staging table first, then move them into '
+                         'the table in batches. An interrupted run resumes where it stopped.'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Resume an interrupted batched update from its last checkpoint.'),
+        make_option('--since', dest='since', default=None,
+                    help='Only update the rows modified since this date or datetime, according to the '
+                         'modified_field of the search manager.'),
+        make_option('--first-pk', dest='first_pk', default=None,
+                    help='Only update the rows with a primary key greater than or equal to this one.'),
+        make_option('--last-pk', dest='last_pk', default=None,
+                    help='Only update the rows with a primary key less than or equal to this one.'),
+    )
+
     def handle(self, app=None, model=None, **options):
         if not app:
             raise CommandError("You must provide an app to update search fields.")
 
-        # check application
+        app_models_for_process = get_search_models(app, model)
+
+        # processing
+
+        workers = options.get('workers') or 1
+        if workers < 1:
+            raise CommandError("--workers must be a positive number.")
+
+        batch_size = options.get('batch_size')
+        staged = options.get('staged', False)
+        if staged and (workers > 1 or options.get('only_changed')):
+            raise CommandError("--staged cannot be used with --workers or --only-changed.")
+
+        resume = options.get('resume', False)
+        if resume and (staged or not batch_size):
+            raise CommandError("--resume needs --batch-size, and staged updates always resume.")
+
+        since = options.get('since')
+        first_pk, last_pk = options.get('first_pk'), options.get('last_pk')
+        if staged and (since or first_pk is not None or last_pk is not None):
+            raise CommandError("--staged cannot be used with --since, --first-pk or --last-pk.")
+        if workers > 1 and (first_pk is not None or last_pk is not None):
+            raise CommandError("--workers cannot be used with --first-pk or --last-pk.")
+
+        update_options = {
+            'batch_size': batch_size,
+            'sleep_between': options.get('sleep_between'),
+            'only_changed': options.get('only_changed', False),
+        }
+        if since:
+            update_options['since'] = parse_since(since)
+            for m in app_models_for_process:
+                if not m._fts_manager.modified_field:
+                    raise CommandError("The search manager of %s has no modified_field, needed by --since." % m)
+
+        for m in app_models_for_process:
+            try:
+                pk_range = tuple(None if x is None else m._meta.pk.to_python(x) for x in (first_pk, last_pk))
+            except ValidationError as e:
+                raise CommandError("Invalid primary key for %s: %s" % (m, "; ".join(e.messages)))
 
-        try:
-            app_module = models.get_app(app)
-        except ImproperlyConfigured:
-            raise CommandError("There is no enabled application matching '%s'." % app)
+            if batch_size or workers > 1 or staged:
+                print("Processing model %s..." % m)
+            else:
+                print("Processing model %s..." % m, end='')
 
-        app_models = []
+            if staged:
+                total = get_estimated_rows(m, m._fts_manager.db)
+                result = m._fts_manager.update_search_field_staged(
+                    batch_size=batch_size or 10000,
+                    sleep_between=update_options['sleep_between'],
+                    progress=self.progress_printer(total=total),
+                    stage_progress=self.progress_printer(verb='staged', total=total),
+                )
+            elif workers > 1:
+                result = self.update_concurrently(m, workers, update_options, resume)
+            elif batch_size:
+                Checkpoint.create_table(m._fts_manager.db)
+                result = self.update_checkpointed(m, Checkpoint(m), pk_range, update_options, resume)
+            else:
+                result = m._fts_manager.update_search_field(
+                    pk_range=pk_range if pk_range != (None, None) else None,
+                    **update_options
+                )
+            print("Done (%d rows updated, %d skipped)" % result)
 
-        # get models
+    def progress_printer(self, prefix='', verb='updated', total=None, checkpoint=None):
+        """
+        Return a progress callback printing the rows processed, the
+        throughput and, given the estimated `total` rows, the remaining time.
+        With a checkpoint, it is saved too.
+        """
+        started = time.time()
+        done = checkpoint.rows if checkpoint is not None else 0
 
-        if model:
-            m = models.get_model(app, model)
-            if not m:
-                raise CommandError("There is no model '%s'." % model)
+        def progress(rows, last_pk):
+            elapsed = time.time() - started
+            rate = rows / elapsed if elapsed > 0 else None
 
-            app_models.append(models.get_model(app, model))
+            line = "  %s%d rows %s (last pk: %s)" % (prefix, done + rows, verb, last_pk)
+            if rate:
+                line += ", %d rows/s" % rate
+                if total is not None:
+                    remaining = max(total - done - rows, 0) / rate
+                    line += ", ETA %s" % timedelta(seconds=int(remaining))
+            print(line)
+
+            if checkpoint is not None:
+                checkpoint.save(done + rows, last_pk, rate)
+
+        return progress
+
+    def update_checkpointed(self, model, checkpoint, pk_range, update_options, resume, total=None, prefix=''):
+        """
+        Update the search field of `model` in the pk_range, saving the
+        progress in `checkpoint`; with resume, continue from its last saved
+        state instead. The progress counts the rows processed, whether they
+        are updated or skipped.
+        """
+        manager = model._fts_manager
+        verb = 'processed' if update_options.get('only_changed') else 'updated'
+
+        if resume and checkpoint.load():
+            if checkpoint.finished:
+                print("  %sAlready done (%d rows %s)" % (prefix, checkpoint.rows, verb))
+                return (0, 0)
+            pk_range = checkpoint.get_resume_range()
+            print("  %sResuming from pk %s (%d rows already %s)" % (prefix, checkpoint.last_pk, checkpoint.rows, verb))
         else:
-            app_models += models.get_models(app_module)
+            checkpoint.start(pk_range)
 
-        # get models only with search managers
+        if total is None:
+            total = get_estimated_rows(model, checkpoint.using)
 
-        app_models_for_process = [x for x in app_models if getattr(x, '_fts_manager', None)]
+        result = manager.update_search_field(
+            pk_range=pk_range if pk_range != (None, None) else None,
+            using=checkpoint.using,
+            progress=self.progress_printer(prefix, verb, total=total, checkpoint=checkpoint),
+            **update_options
+        )
+        checkpoint.finish()
+        return result
 
-        if not app_models_for_process:
-            raise CommandError("There is no models for processing.")
+    def update_concurrently(self, model, workers, update_options, resume=False):
+        """
+        Update the search field of `model` splitting the table in `workers`
+        pk ranges, each one processed by a thread with its own connection.
+        With batches, each range has its own checkpoint, named after the
+        number of ranges, which can be lower than `workers` for small tables:
+        a resumed update continues the ranges of its checkpoints.
+        """
+        manager = model._fts_manager
+        using = manager.db
 
-        # processing
+        checkpoints = []
+        if update_options['batch_size']:
+            Checkpoint.create_table(using)
+            if resume:
+                checkpoints = Checkpoint.load_parts(model, using)
+                parts = set(x.key[2].split('/')[1] for x in checkpoints)
+                if checkpoints and parts != set([str(len(checkpoints))]):
+                    raise CommandError("The checkpoints of %s are incomplete." % model)
 
-        for m in app_models_for_process:
-            print("Processing model %s..." % m, end='')
-            m._fts_manager.update_search_field()
-            print("Done")
+        if checkpoints:
+            ranges = [checkpoint.pk_range for checkpoint in checkpoints]
+        else:
+            resume = False
+            ranges = manager._split_pk_range(workers, using=using)
+            if update_options['batch_size']:
+                Checkpoint.clear_parts(model, using)
+                checkpoints = [Checkpoint(model, "%d/%d" % (number, len(ranges)), using)
+                               for number in range(1, len(ranges) + 1)]
+
+        total = get_estimated_rows(model, using)
+        if total is not None:
+            total //= len(ranges)
+
+        results, errors = [], []
+
+        def work(number, pk_range):
+            try:
+                prefix = "[worker %d] " % number
+                if update_options['batch_size']:
+                    results.append(self.update_checkpointed(
+                        model, checkpoints[number - 1], pk_range, update_options, resume, total, prefix
+                    ))
+                else:
+                    results.append(manager.update_search_field(pk_range=pk_range, using=using, **update_options))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # Connections are per thread, close the one opened by this worker.
+                connections[using].close()
+
+        threads = [threading.Thread(target=work, args=(number, pk_range))
+                   for number, pk_range in enumerate(ranges, 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise CommandError("Updating %s failed: %s" % (model, errors[0]))
+
+        return tuple(sum(x) for x in zip(*results))
@@ -1,15 +1,36 @@
 # -*- coding: utf-8 -*-
+from collections import namedtuple, OrderedDict
 from itertools import repeat
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+
 import six
 
-from django.db import models, connections
-from django.db.models.query import QuerySet
-from django.utils.encoding import smart_text
+from django.conf import settings
+from django.db import models, connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import sql
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet, RawQuerySet
+from django.utils.encoding import force_bytes, smart_text
 
-from djorm_pgfulltext.utils import adapt
+from djorm_pgfulltext.utils import InlineSQL, get_normalized_tsquery, get_tsquery_cache_size
 
 # Compatibility import and fixes section.
 
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+try:
+    from django.db.backends.utils import truncate_name
+except ImportError:
+    from django.db.backends.util import truncate_name
+
 try:
     from django.db.transaction import atomic
 except ImportError:
@@ -18,8 +39,6 @@ except ImportError:
     # decorator. This not intends to emulate django 1.6 atomic
     # behavior, only has partially same interface for easy
     # use.
-    from django.db import transaction
-
     class atomic(object):
         def __init__(self, using=None):
             self.using = using
@@ -41,9 +60,156 @@ except ImportError:
                 if self.forced_managed:
                     transaction.leave_transaction_management(using=self.using)
 
+# Django < 1.9 has no on_commit hooks, deferred updates are run immediately.
+on_commit = getattr(transaction, 'on_commit', None)
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+# Weights of the labels used by ts_rank and ts_rank_cd when none are given.
+DEFAULT_RANK_WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2, 'D': 0.1}
+
+SearchFieldUpdate = namedtuple('SearchFieldUpdate', ['updated', 'skipped'])
+
+
+_deferred_updates = threading.local()
+
+
+def defer_search_field_update(model, pk, using):
+    """
+    Queue the update of the search field of the instance of `model` with
+    this `pk`, to be run when the current transaction of `using` commits.
+    All the instances queued during a transaction are updated with one
+    statement per model, and forgotten if it is rolled back (those queued
+    in a rolled back savepoint are still updated, which is harmless).
+    """
+    if not hasattr(_deferred_updates, 'pending'):
+        _deferred_updates.pending = {}
+
+    hook, pending = _deferred_updates.pending.get(using, (None, None))
+    if hook is not None and not any(x[1] is hook for x in connections[using].run_on_commit):
+        # The transaction that queued these updates was rolled back along
+        # with its hook, forget them.
+        hook = pending = None
+
+    if hook is not None:
+        pending.setdefault(model, set()).add(pk)
+        return
+
+    # One hook per transaction runs the updates it queued. Outside of a
+    # transaction, it is run right away.
+    pending = {model: set([pk])}
+
+    def hook():
+        flush_deferred_search_field_updates(using)
+
+    _deferred_updates.pending[using] = (hook, pending)
+    on_commit(hook, using=using)
+
+
+def flush_deferred_search_field_updates(using):
+    """
+    Run the search field updates queued by defer_search_field_update for `using`.
+    """
+    pending = getattr(_deferred_updates, 'pending', {}).pop(using, (None, None))[1]
+    if not pending:
+        return
+
+    for model, pks in pending.items():
+        # Sorted keys make concurrent flushes lock rows in the same order.
+        model._fts_manager.update_search_field(pk=sorted(pks), using=using)
+
+
+def get_search_cache():
+    """
+    Return the cache storing search results, settings.PGFULLTEXT_CACHE
+    ('default' by default).
+    """
+    return get_cache(getattr(settings, 'PGFULLTEXT_CACHE', 'default'))
+
+
+def _get_search_cache_generation_key(model):
+    return 'pgfulltext:generation:%s' % model._meta.db_table
+
+
+def get_search_cache_generation(model):
+    """
+    Return the token the cached search results of `model` are stored with,
+    which changes every time they are invalidated.
+    """
+    cache = get_search_cache()
+    key = _get_search_cache_generation_key(model)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def invalidate_search_cache(model, using=None):
+    """
+    Invalidate the cached search results of `model`, now and again when
+    the current transaction of `using` commits (Django >= 1.9), since until
+    then other connections still read, and may cache, the old rows.
+    """
+    def invalidate():
+        get_search_cache().set(_get_search_cache_generation_key(model), uuid.uuid4().hex, None)
+
+    invalidate()
+    if on_commit is not None:
+        on_commit(invalidate, using=using)
+
 
 def auto_update_search_field_handler(sender, instance, *args, **kwargs):
-    instance.update_search_field()
+    manager = sender._fts_manager
+    if not kwargs.get('created') and not manager._search_fields_changed(instance, kwargs.get('update_fields')):
+        return
+
+    if manager.track_field_changes:
+        manager._save_search_field_values(instance)
+
+    if manager._can_update_inline():
+        # The vector has been saved by the INSERT/UPDATE itself, unless
+        # it was left out by update_fields.
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or manager.search_field in update_fields:
+            if manager.cache_timeout is not None:
+                invalidate_search_cache(sender, kwargs.get('using') or manager.db)
+            return
+
+    if manager.auto_update_on_commit and on_commit is not None:
+        defer_search_field_update(sender, instance.pk, kwargs.get('using') or manager.db)
+    else:
+        instance.update_search_field()
+
+
+def track_search_field_values_handler(sender, instance, *args, **kwargs):
+    sender._fts_manager._save_search_field_values(instance)
+
+
+def prepare_search_vector_handler(sender, **kwargs):
+    # Compile the default search vector once the model has all its fields.
+    # Custom converters may need an extra argument, so they are left alone.
+    manager = sender._fts_manager
+    if manager.search_field and not hasattr(sender, '_convert_field_to_db') and DEFAULT_DB_ALIAS in connections:
+        manager._get_search_vector(manager.config, DEFAULT_DB_ALIAS)
+
+
+def _freeze(value):
+    """
+    Return a hashable version of `value`, made of lists, tuples and dicts.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
 
 
 class SearchManagerMixIn(object):
@@ -62,16 +228,39 @@ class SearchManagerMixIn(object):
     When using search_field, if auto_update = True, Django signals will be used to
     automatically syncronize the search_field with the searched fields every time instances
     are saved. If not, you can call to 'update_search_field' method in model instances to do this.
+    With auto_update_on_commit = True, the instances saved inside a transaction are not updated
+    one by one but all together, with one statement per model, when the transaction commits
+    (Django >= 1.9; with older versions they are updated immediately).
+    Saves given an update_fields list without any searched field do not update the search_field.
+    With auto_update_inline = True, the search_field is instead computed from the values of the
+    instance inside the INSERT/UPDATE statement of the save itself, so there is no second statement
+    (not available if the model defines its own _convert_field_to_db).
+    With track_field_changes = True, the values of the searched fields are also remembered when
+    instances are loaded, and saves that did not change any of them skip the update.
+    With rank_boost_field, the name of a numeric model field, the search ranks are multiplied by
+    its value (1 if null), to combine them with a static score or a precomputed normalization,
+    such as one of the document length, stored in each row.
+    The modified_field is the name of a DateTimeField holding when the rows were last changed, so
+    update_search_field(since=...) can repair only the rows changed since a given time.
+    With cache_timeout set (in seconds), search(cache=True) caches the keys of the results for this
+    long, and the cached results of the model are invalidated whenever its search_field is written
+    by update_search_field or by the auto update (but not by triggers or raw SQL).
     If search_field not used, both auto_update and update_search_field does nothing. Alternatively,
     you can create a postgresql trigger to do the syncronization at database level, see this:
 
     http://www.postgresql.org/docs/9.1/interactive/textsearch-features.html#TEXTSEARCH-UPDATE-TRIGGERS
 
+    The trigger can be generated from the manager definition, using the CreateSearchTrigger
+    migration operation, the create_search_trigger management command or get_search_trigger_sql.
+    It also keeps the search_field up to date on QuerySet.update() and raw SQL writes.
+
     In both cases, you should create a text search index, on either the searched fields or
     the compound search_field, like explained here:
 
     http://www.postgresql.org/docs/9.1/interactive/textsearch-tables.html#TEXTSEARCH-TABLES-INDEX
 
+    See the CreateSearchIndex and CreateSearchExpressionIndex migration operations.
+
     Finally, you can give a 'config', the Postgres text search configuration that will be used
     to normalize the search_field and the queries. How do you can create a configuration:
 
@@ -90,12 +279,25 @@ class SearchManagerMixIn(object):
                  fields=None,
                  search_field='search_index',
                  config='pg_catalog.english',
-                 auto_update_search_field=False):
+                 auto_update_search_field=False,
+                 auto_update_on_commit=False,
+                 track_field_changes=False,
+                 auto_update_inline=False,
+                 cache_timeout=None,
+                 rank_boost_field=None,
+                 modified_field=None):
         self.search_field = search_field
         self.default_weight = 'D'
         self.config = config
         self.auto_update_search_field = auto_update_search_field
+        self.auto_update_on_commit = auto_update_on_commit
+        self.track_field_changes = track_field_changes
+        self.auto_update_inline = auto_update_inline
+        self.cache_timeout = cache_timeout
+        self.rank_boost_field = rank_boost_field
+        self.modified_field = modified_field
         self._fields = fields
+        self._search_vectors = {}
 
         super(SearchManagerMixIn, self).__init__()
 
@@ -111,15 +313,21 @@ class SearchManagerMixIn(object):
             # Add 'update_search_field' instance method, that calls manager's update_search_field.
             if not getattr(cls, 'update_search_field', None):
                 def update_search_field(self, search_field=None, fields=None, using=None, config=None, extra=None):
-                    self._fts_manager.update_search_field(
+                    return self._fts_manager.update_search_field(
                         pk=self.pk, search_field=search_field, fields=fields, using=using, config=config, extra=extra
                     )
 
                 setattr(cls, 'update_search_field', update_search_field)
 
+            if cls._fts_manager is self:
+                models.signals.class_prepared.connect(prepare_search_vector_handler, sender=cls)
+
             if self.auto_update_search_field:
                 models.signals.post_save.connect(auto_update_search_field_handler, sender=cls)
 
+                if self.track_field_changes:
+                    models.signals.post_init.connect(track_search_field_values_handler, sender=cls)
+
         super(SearchManagerMixIn, self).contribute_to_class(cls, name)
 
     def get_queryset(self):
@@ -128,23 +336,147 @@ class SearchManagerMixIn(object):
     def search(self, *args, **kwargs):
         return self.get_queryset().search(*args, **kwargs)
 
-    def update_search_field(self, pk=None, search_field=None, fields=None, config=None, using=None, extra=None):
+    def search_top(self, *args, **kwargs):
+        return self.get_queryset().search_top(*args, **kwargs)
+
+    def update_search_field(self, pk=None, search_field=None, fields=None, config=None, using=None, extra=None,
+                            batch_size=None, sleep_between=None, progress=None, only_changed=False,
+                            pk_range=None, queryset=None, since=None):
         """
         Update the search_field of one instance, or a list of instances, or
-        all instances in the table (pk is one key, a list of keys or none).
-
-        If there is no search_field, this function does nothing.
+        all instances in the table (pk is one key, a list of keys, a queryset
+        of the model or none). A list of keys is sent as a single array
+        parameter, and a queryset is run by the database as a subquery, so
+        its keys are never read into Python.
+        The update can be restricted to a range of primary keys with pk_range,
+        a (first, last) tuple where both ends are included and either may be None
+        (a third item, if False, leaves last out, as in the half-open ranges of
+        _split_pk_range, and a fourth one, if False, leaves first out), to the
+        rows of a queryset of the model (run as a subquery), and to the rows
+        whose modified_field (see the manager) is not older than `since`.
+
+        If batch_size is given, rows are updated in chunks of at most batch_size
+        rows, each one committed in its own transaction, so the table can be
+        reindexed online. When updating the whole table, chunks are built walking
+        the primary key (keyset pagination) instead of using OFFSET.
+
+        If only_changed is True, rows whose search_field already holds the
+        computed vector are not written, avoiding dead tuples and index churn.
+
+        If there is no search_field, or it is a generated column, this function does nothing.
         :param pk: Primary key of instance
         :param search_field: search_field which will be updated
         :param fields: fields from which we update the search_field
         :param config: config of full text search
         :param using: DB we are using
+        :param batch_size: maximum number of rows updated per transaction
+        :param sleep_between: seconds to wait between two batches
+        :param progress: callable called after each batch as progress(rows, last_pk), rows
+                         being the number of rows processed so far, updated or skipped
+        :param only_changed: skip rows whose search_field would not change
+        :param pk_range: (first, last) tuple of primary keys limiting the update
+        :param queryset: queryset of the model limiting the update
+        :param since: datetime limiting the update to the rows modified since then
+        :return: a SearchFieldUpdate with the number of updated and skipped rows
         """
         if not search_field:
             search_field = self.search_field
 
+        if not search_field or self._is_generated(search_field):
+            return SearchFieldUpdate(0, 0)
+
+        if fields is None:
+            fields = self._fields
+
+        if not config:
+            config = self.config
+
+        if using is None:
+            using = self.db
+
+        connection = connections[using]
+        qn = connection.ops.quote_name
+
+        search_vector = self._get_search_vector(config, using, fields=fields, extra=extra) or "''"
+
+        if isinstance(pk, QuerySet):
+            queryset = pk if queryset is None else queryset & pk
+            pk = None
+        elif pk is not None and not isinstance(pk, (list, tuple)):
+            pk = [pk]
+
+        try:
+            filter_where, filter_params = self._get_update_filter(pk_range, queryset, since, using)
+        except EmptyResultSet:
+            return SearchFieldUpdate(0, 0)
+
+        if batch_size:
+            if pk is None:
+                batches = self._iter_keyset_batches(batch_size, using, filter_where, filter_params)
+            else:
+                batches = self._iter_pk_batches(pk, batch_size, using)
+        else:
+            batches = [self._get_pk_batch(pk, using)]
+
+        updated = skipped = 0
+        for index, (where, params, last_pk) in enumerate(batches):
+            if index and sleep_between:
+                time.sleep(sleep_between)
+
+            where = filter_where + where
+            params = filter_params + params
+            where_sql = "WHERE %s" % " AND ".join(where) if where else ""
+
+            with atomic(using=using):
+                cursor = connection.cursor()
+                if only_changed:
+                    cursor.execute(self._get_update_changed_sql(search_field, search_vector, where_sql, using), params)
+                    candidates, rows = cursor.fetchone()
+                    skipped += candidates - rows
+                else:
+                    cursor.execute("UPDATE %s SET %s = %s %s;" % (
+                        qn(self.model._meta.db_table),
+                        qn(search_field),
+                        search_vector,
+                        where_sql
+                    ), params)
+                    rows = cursor.rowcount
+                updated += rows
+
+            if progress is not None:
+                progress(updated + skipped, last_pk)
+
+        if updated and self.cache_timeout is not None:
+            invalidate_search_cache(self.model, using)
+
+        return SearchFieldUpdate(updated, skipped)
+
+    def update_search_field_staged(self, search_field=None, fields=None, config=None, using=None, extra=None,
+                                   batch_size=10000, sleep_between=None, progress=None, stage_progress=None):
+        """
+        Update the search_field of the whole table in two steps, for the
+        initial indexing of big tables:
+
+        1. The vectors are computed into an UNLOGGED staging table, walking the
+           table by primary key in batches of batch_size rows, each one in its
+           own transaction. The table itself is only read.
+        2. The staged vectors are moved into the table, batch_size rows at a
+           time: each transaction deletes a batch from the staging table and
+           updates the same rows with it. Rows modified since their vector was
+           staged get their vector computed again.
+
+        The staging table is dropped at the end. If the update is interrupted,
+        calling this again resumes it from what is left in the staging table.
+
+        :param progress: callable called after each moved batch as progress(rows, last_pk)
+        :param stage_progress: callable called after each staged batch as stage_progress(rows, last_pk)
+        :return: a SearchFieldUpdate with the number of updated rows
+        """
         if not search_field:
-            return
+            search_field = self.search_field
+
+        if not search_field or self._is_generated(search_field):
+            return SearchFieldUpdate(0, 0)
 
         if fields is None:
             fields = self._fields
@@ -157,31 +489,512 @@ class SearchManagerMixIn(object):
 
         connection = connections[using]
         qn = connection.ops.quote_name
+        search_vector = self._get_search_vector(config, using, fields=fields, extra=extra) or "''"
+        sql_params = {
+            'table': qn(self.model._meta.db_table),
+            'pk': qn(self.model._meta.pk.column),
+            'field': qn(search_field),
+            'vector': search_vector,
+            'staging': self._get_staging_table_name(search_field, using),
+        }
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regclass(%s)", [sql_params['staging']])
+        if cursor.fetchone()[0] is None:
+            with atomic(using=using):
+                cursor.execute(
+                    "CREATE UNLOGGED TABLE %(staging)s AS SELECT %(pk)s AS pk, xmin AS row_xmin, "
+                    "%(vector)s AS vector FROM %(table)s LIMIT 0;" % sql_params
+                )
+                cursor.execute("ALTER TABLE %(staging)s ADD PRIMARY KEY (pk);" % sql_params)
+
+        # Merged rows are removed from the lowest keys up, so the highest
+        # staged key is where the staging stopped. Keys are read in order
+        # since max() does not exist for every key type (such as uuid).
+        cursor.execute("SELECT pk FROM %(staging)s ORDER BY pk DESC LIMIT 1;" % sql_params)
+        row = cursor.fetchone()
+        last_pk = row[0] if row is not None else None
+
+        staged = 0
+        while True:
+            if staged and sleep_between:
+                time.sleep(sleep_between)
+
+            with atomic(using=using):
+                cursor = connection.cursor()
+                cursor.execute(
+                    "WITH staged AS (INSERT INTO %(staging)s (pk, row_xmin, vector) "
+                    "SELECT %(table)s.%(pk)s, %(table)s.xmin, %(vector)s FROM %(table)s %(where)s "
+                    "ORDER BY %(table)s.%(pk)s LIMIT %%s RETURNING pk) "
+                    "SELECT (SELECT count(*) FROM staged), (SELECT pk FROM staged ORDER BY pk DESC LIMIT 1);" % dict(
+                        sql_params, where="WHERE %(table)s.%(pk)s > %%s" % sql_params if last_pk is not None else ""
+                    ),
+                    ([last_pk] if last_pk is not None else []) + [batch_size]
+                )
+                rows, batch_last_pk = cursor.fetchone()
+
+            if not rows:
+                break
+
+            staged += rows
+            last_pk = batch_last_pk
+            if stage_progress is not None:
+                stage_progress(staged, last_pk)
+
+            if rows < batch_size:
+                break
+
+        updated = batches = 0
+        while True:
+            if batches and sleep_between:
+                time.sleep(sleep_between)
+
+            with atomic(using=using):
+                cursor = connection.cursor()
+                cursor.execute(
+                    "WITH batch AS (DELETE FROM %(staging)s WHERE pk IN "
+                    "(SELECT pk FROM %(staging)s ORDER BY pk LIMIT %%s) RETURNING pk, row_xmin, vector), "
+                    "updated AS (UPDATE %(table)s SET %(field)s = CASE WHEN %(table)s.xmin = batch.row_xmin "
+                    "THEN batch.vector ELSE %(vector)s END FROM batch WHERE %(table)s.%(pk)s = batch.pk "
+                    "RETURNING 1) "
+                    "SELECT (SELECT count(*) FROM batch), (SELECT pk FROM batch ORDER BY pk DESC LIMIT 1), "
+                    "(SELECT count(*) FROM updated);" % sql_params,
+                    [batch_size]
+                )
+                rows, batch_last_pk, batch_updated = cursor.fetchone()
 
-        where_sql = ''
-        params = []
-        if pk is not None:
-            if isinstance(pk, (list, tuple)):
-                params = pk
+            if not rows:
+                break
+
+            batches += 1
+            updated += batch_updated
+            if progress is not None:
+                progress(updated, batch_last_pk)
+
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE %(staging)s;" % sql_params)
+
+        if updated and self.cache_timeout is not None:
+            invalidate_search_cache(self.model, using)
+
+        return SearchFieldUpdate(updated, 0)
+
+    def _get_staging_table_name(self, search_field, using):
+        connection = connections[using]
+        return connection.ops.quote_name(truncate_name(
+            "%s_%s_staging" % (self.model._meta.db_table, search_field),
+            connection.ops.max_name_length()
+        ))
+
+    def _is_generated(self, search_field):
+        try:
+            field = self.model._meta.get_field(search_field)
+        except FieldDoesNotExist:
+            return False
+        return getattr(field, 'generated', False)
+
+    def _get_update_changed_sql(self, search_field, search_vector, where_sql, using):
+        """
+        Build a statement that computes the vector of every selected row once,
+        only writes the rows where it differs from the stored one, and returns
+        the number of selected and written rows.
+        """
+        qn = connections[using].ops.quote_name
+        table = qn(self.model._meta.db_table)
+        pk_column = qn(self.model._meta.pk.column)
+
+        return (
+            "WITH candidates AS (SELECT %(pk)s AS pk, %(vector)s AS vector FROM %(table)s %(where)s), "
+            "updated AS (UPDATE %(table)s SET %(field)s = candidates.vector FROM candidates "
+            "WHERE %(table)s.%(pk)s = candidates.pk AND %(table)s.%(field)s IS DISTINCT FROM candidates.vector "
+            "RETURNING 1) "
+            "SELECT (SELECT count(*) FROM candidates), (SELECT count(*) FROM updated);"
+        ) % {
+            'pk': pk_column,
+            'vector': search_vector,
+            'table': table,
+            'where': where_sql,
+            'field': qn(search_field),
+        }
+
+    def _get_search_trigger_name(self, search_field, suffix, using, name=None):
+        connection = connections[using]
+        return connection.ops.quote_name(truncate_name(
+            "%s_%s" % (name or "%s_%s" % (self.model._meta.db_table, search_field), suffix),
+            connection.ops.max_name_length()
+        ))
+
+    def get_search_trigger_sql(self, search_field=None, fields=None, config=None, using=None, extra=None,
+                               name=None):
+        """
+        Return the list of statements creating a trigger that keeps the
+        search_field up to date on every INSERT, and on every UPDATE changing
+        one of the searched fields (or the search_field itself). The names
+        of the function and triggers start with `name`, by default the table
+        and search_field names.
+        """
+        if not search_field:
+            search_field = self.search_field
+
+        if not search_field:
+            raise ValueError("search_field is not specified")
+
+        if fields is None:
+            fields = self._fields
+
+        if not config:
+            config = self.config
+
+        if using is None:
+            using = self.db
+
+        qn = connections[using].ops.quote_name
+        table = qn(self.model._meta.db_table)
+        function = self._get_search_trigger_name(search_field, 'trigger', using, name)
+        insert_trigger = self._get_search_trigger_name(search_field, 'insert', using, name)
+        update_trigger = self._get_search_trigger_name(search_field, 'update', using, name)
+
+        # The vector refers to the columns of the table, the trigger to the new row.
+        search_vector = self._get_search_vector(config, using, fields=fields, extra=extra) or "''"
+        search_vector = search_vector.replace("%s." % table, "NEW.")
+
+        columns = [
+            qn(self.model._meta.get_field(field_name).column) for field_name, weight in self._parse_fields(fields)
+        ]
+        columns.append(qn(search_field))
+
+        return [
+            "CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$\n"
+            "BEGIN\n"
+            "    NEW.%s := %s;\n"
+            "    RETURN NEW;\n"
+            "END\n"
+            "$$ LANGUAGE plpgsql;" % (function, qn(search_field), search_vector),
+            "DROP TRIGGER IF EXISTS %s ON %s;" % (insert_trigger, table),
+            "CREATE TRIGGER %s BEFORE INSERT ON %s FOR EACH ROW EXECUTE PROCEDURE %s();" % (
+                insert_trigger, table, function
+            ),
+            "DROP TRIGGER IF EXISTS %s ON %s;" % (update_trigger, table),
+            "CREATE TRIGGER %s BEFORE UPDATE OF %s ON %s FOR EACH ROW WHEN (%s) EXECUTE PROCEDURE %s();" % (
+                update_trigger,
+                ', '.join(columns),
+                table,
+                ' OR '.join("OLD.%s IS DISTINCT FROM NEW.%s" % (x, x) for x in columns),
+                function
+            ),
+        ]
+
+    def get_drop_search_trigger_sql(self, search_field=None, using=None, name=None):
+        """
+        Return the list of statements dropping the trigger created with
+        the statements of get_search_trigger_sql.
+        """
+        if not search_field:
+            search_field = self.search_field
+
+        if using is None:
+            using = self.db
+
+        table = connections[using].ops.quote_name(self.model._meta.db_table)
+
+        return [
+            "DROP TRIGGER IF EXISTS %s ON %s;" % (
+                self._get_search_trigger_name(search_field, 'insert', using, name), table
+            ),
+            "DROP TRIGGER IF EXISTS %s ON %s;" % (
+                self._get_search_trigger_name(search_field, 'update', using, name), table
+            ),
+            "DROP FUNCTION IF EXISTS %s();" % self._get_search_trigger_name(search_field, 'trigger', using, name),
+        ]
+
+    def _get_search_expression_index_name(self, fields, config, using, name=None):
+        connection = connections[using]
+        if name:
+            return connection.ops.quote_name(name)
+
+        parsed_fields = self._parse_fields(fields)
+        # Hashed as plain text, the same on every Python version.
+        digest = hashlib.md5(force_bytes(
+            '|'.join('%s:%s' % (field, weight or '') for field, weight in parsed_fields) + '|' + config
+        )).hexdigest()[:8]
+        return connection.ops.quote_name(truncate_name(
+            "%s_%s_%s" % (self.model._meta.db_table, "_".join(x[0] for x in parsed_fields), digest),
+            connection.ops.max_name_length()
+        ))
+
+    def get_search_expression_index_sql(self, fields=None, config=None, using=None, concurrently=False,
+                                        name=None):
+        """
+        Return the statement creating a GIN index on the vector expression
+        that search(fields=fields, config=config) filters on, for searches
+        made without a search_field. Both are built by _get_search_vector,
+        so the index matches the queries. The index is named `name`, by
+        default after the table, the fields and a hash of fields and config.
+        """
+        if fields is None:
+            fields = self._fields
+
+        if not config:
+            config = self.config
+
+        if using is None:
+            using = self.db
+
+        return "CREATE INDEX %s%s ON %s USING gin ((%s));" % (
+            "CONCURRENTLY " if concurrently else "",
+            self._get_search_expression_index_name(fields, config, using, name),
+            connections[using].ops.quote_name(self.model._meta.db_table),
+            self._get_search_vector(config, using, fields=fields)
+        )
+
+    def get_drop_search_expression_index_sql(self, fields=None, config=None, using=None, concurrently=False,
+                                             name=None):
+        if fields is None:
+            fields = self._fields
+
+        if not config:
+            config = self.config
+
+        if using is None:
+            using = self.db
+
+        return "DROP INDEX %sIF EXISTS %s;" % (
+            "CONCURRENTLY " if concurrently else "",
+            self._get_search_expression_index_name(fields, config, using, name)
+        )
+
+    def _get_update_filter(self, pk_range, queryset, since, using):
+        """
+        Return the (where, params) pair restricting a statement to pk_range,
+        the rows of queryset and the ones modified since `since`. Raise
+        EmptyResultSet if the queryset cannot match any row.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        where, params = self._get_pk_range_filter(pk_range, using)
+
+        if since is not None:
+            if not self.modified_field:
+                raise ValueError("The search manager of %s has no modified_field" % self.model.__name__)
+            field = self.model._meta.get_field(self.modified_field)
+            where.append("%s >= %%s" % qn(field.column))
+            params.append(field.get_db_prep_value(since, connection))
+
+        if queryset is not None:
+            # Compiled on its own, so its columns refer to the table of the subquery.
+            sql, queryset_params = queryset.values('pk').query.get_compiler(using).as_sql()
+            where.append("%s IN (%s)" % (qn(self.model._meta.pk.column), sql))
+            params.extend(queryset_params)
+
+        return where, params
+
+    def _get_pk_range_filter(self, pk_range, using):
+        """
+        Return the (where, params) pair restricting a statement to pk_range.
+        """
+        where, params = [], []
+        if pk_range is None:
+            return where, params
+
+        pk_column = connections[using].ops.quote_name(self.model._meta.pk.column)
+        first, last = pk_range[:2]
+        last_included, first_included = (tuple(pk_range[2:]) + (True, True))[:2]
+        if first is not None:
+            where.append("%s %s %%s" % (pk_column, ">=" if first_included else ">"))
+            params.append(first)
+        if last is not None:
+            where.append("%s %s %%s" % (pk_column, "<=" if last_included else "<"))
+            params.append(last)
+
+        return where, params
+
+    def _split_pk_range(self, parts, using=None):
+        """
+        Split the table in at most `parts` pk ranges holding about the same
+        number of rows, suitable as pk_range of update_search_field. Each
+        range starts at the first key of its slice and ends before the first
+        key of the next one, and the first and last ranges are open, so rows
+        inserted meanwhile are not left out.
+        """
+        if using is None:
+            using = self.db
+
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        pk_column = qn(self.model._meta.pk.column)
+
+        # Keys are picked by their position in the key order, since min()
+        # and max() do not exist for every key type (such as uuid).
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT %s FROM (SELECT %s, row_number() OVER (ORDER BY %s) - 1 AS position, count(*) OVER () AS total "
+            "FROM %s) AS keys WHERE position %%%% ((total + %%s - 1) / %%s) = 0 ORDER BY %s;" % (
+                pk_column, pk_column, pk_column, qn(self.model._meta.db_table), pk_column
+            ),
+            [parts, parts]
+        )
+        bounds = [None] + [x[0] for x in cursor.fetchall()[1:]] + [None]
+        return [(first, last, False) if last is not None else (first, None)
+                for first, last in zip(bounds, bounds[1:])]
+
+    def _get_pk_batch(self, pk, using):
+        """
+        Return the (where, params, last_pk) triple selecting the rows with
+        the given list of keys, or every row if pk is None.
+        """
+        if pk is None:
+            return [], [], None
+
+        connection = connections[using]
+        pk_field = self.model._meta.pk
+        where = "%s = ANY(%%s)" % connection.ops.quote_name(pk_field.column)
+        # The array is typed after its items, so keys given as strings are
+        # converted first, as the database would do with single values.
+        keys = [pk_field.to_python(x) for x in pk]
+        return [where], [[pk_field.get_db_prep_value(x, connection) for x in keys]], keys[-1] if keys else None
+
+    def _iter_pk_batches(self, pk, batch_size, using):
+        for start in range(0, len(pk), batch_size):
+            yield self._get_pk_batch(pk[start:start + batch_size], using)
+
+    def _iter_keyset_batches(self, batch_size, using, filter_where=(), filter_params=()):
+        """
+        Walk the whole table by primary key, yielding one range of at most
+        batch_size rows at a time. Each range is bounded by the keys read just
+        before it is yielded, so rows inserted meanwhile are not skipped.
+        Only the rows matching filter_where are counted in a batch.
+        """
+        pk_column = connections[using].ops.quote_name(self.model._meta.pk.column)
+
+        last_pk = None
+        while True:
+            if last_pk is None:
+                lower, lower_params = [], []
             else:
-                params = [pk]
+                lower, lower_params = ["%s > %%s" % pk_column], [last_pk]
 
-            where_sql = "WHERE %s IN (%s)" % (
-                qn(self.model._meta.pk.column),
-                ','.join(repeat("%s", len(params)))
-            )
+            where = list(filter_where) + lower
+            params = list(filter_params) + lower_params
+
+            # The bound is read from the key order rather than with max(),
+            # which does not exist for every key type (such as uuid).
+            upper_pk = self._get_ordered_pk(where, params, using, offset=batch_size - 1)
+            full = upper_pk is not None
+            if not full:
+                upper_pk = self._get_ordered_pk(where, params, using, descending=True)
+                if upper_pk is None:
+                    return
+
+            yield lower + ["%s <= %%s" % pk_column], lower_params + [upper_pk], upper_pk
+
+            if not full:
+                return
+            last_pk = upper_pk
+
+    def _get_ordered_pk(self, where, params, using, offset=0, descending=False):
+        """
+        Return the primary key at `offset` among the rows matching `where`
+        in key order (or reverse key order), or None if there is none.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        pk_column = qn(self.model._meta.pk.column)
 
-        search_vector = self._get_search_vector(config, using, fields=fields, extra=extra)
-        sql = "UPDATE %s SET %s = %s %s;" % (
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s FROM %s %s ORDER BY %s%s LIMIT 1 OFFSET %%s;" % (
+            pk_column,
             qn(self.model._meta.db_table),
-            qn(search_field),
-            search_vector or "''",
-            where_sql
+            "WHERE %s" % " AND ".join(where) if where else "",
+            pk_column,
+            " DESC" if descending else ""
+        ), list(params) + [offset])
+        row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    def _can_update_inline(self):
+        # Custom converters build SQL on the table columns, which cannot be
+        # computed from the values of an instance.
+        return self.auto_update_inline and not hasattr(self.model, '_convert_field_to_db')
+
+    def _get_inline_search_vector(self, instance):
+        """
+        Return the search vector of `instance` as an SQL expression built from
+        its values, to be saved by the INSERT/UPDATE of the instance.
+        """
+        if getattr(self, '_inline_search_vector', None) is None:
+            configs = self.config
+            if isinstance(configs, six.string_types[0]):
+                configs = [configs]
+
+            search_vector, attnames = [], []
+            for config in configs:
+                for field_name, weight in self._parse_fields(self._fields):
+                    search_vector.append(
+                        "setweight(to_tsvector('%s', %%s), '%s')" % (config, weight or self.default_weight)
+                    )
+                    attnames.append(self.model._meta.get_field(field_name).attname)
+            self._inline_search_vector = (' || '.join(search_vector) or "''", attnames)
+
+        sql, attnames = self._inline_search_vector
+        params = []
+        for attname in attnames:
+            value = getattr(instance, attname)
+            params.append('' if value is None else smart_text(value))
+
+        return InlineSQL(sql, params)
+
+    def _get_search_field_attnames(self):
+        """
+        Return the attnames of the model fields the search_field is built from.
+        """
+        if getattr(self, '_search_field_attnames', None) is None:
+            self._search_field_attnames = tuple(
+                self.model._meta.get_field(name).attname for name, weight in self._parse_fields(self._fields)
+            )
+        return self._search_field_attnames
+
+    def _save_search_field_values(self, instance):
+        # Read the instance __dict__, so deferred fields are not loaded.
+        instance._fts_field_values = dict(
+            (attname, instance.__dict__[attname])
+            for attname in self._get_search_field_attnames() if attname in instance.__dict__
         )
 
-        with atomic():
-            cursor = connection.cursor()
-            cursor.execute(sql, params)
+    def _updates_search_field(self):
+        """
+        Tell if this manager keeps the search_field up to date from Django.
+        """
+        return bool(self.auto_update_search_field and self.search_field and not self._is_generated(self.search_field))
+
+    def _search_fields_updated(self, update_fields):
+        """
+        Tell if writing the fields named in `update_fields` changes the search_field.
+        """
+        names = set(self._get_search_field_attnames())
+        names.update(name for name, weight in self._parse_fields(self._fields))
+        return bool(names.intersection(update_fields))
+
+    def _search_fields_changed(self, instance, update_fields=None):
+        """
+        Tell if a save of `instance` may have changed any searched field.
+        """
+        attnames = self._get_search_field_attnames()
+
+        if update_fields is not None and not self._search_fields_updated(update_fields):
+            return False
+
+        values = getattr(instance, '_fts_field_values', None)
+        if values is None:
+            return True
+
+        for attname in attnames:
+            if attname not in instance.__dict__:
+                # Still deferred, so it has not been modified.
+                continue
+            if attname not in values or values[attname] != instance.__dict__[attname]:
+                return True
+
+        return False
 
     def _find_text_fields(self):
         fields = [f for f in self.model._meta.fields
@@ -191,30 +1004,55 @@ class SearchManagerMixIn(object):
 
     def _parse_fields(self, fields):
         """
-        Parse fields list into a correct format needed by this manager.
+        Parse fields list into a correct format needed by this manager: a tuple
+        of (field_name, weight) pairs, in the given order (the model order for
+        the default text fields), so the same fields always build the same SQL.
         If any field does not exist, raise ValueError.
         """
 
-        parsed_fields = set()
+        parsed_fields = OrderedDict()
 
         if fields is not None and isinstance(fields, (list, tuple)):
             if len(fields) > 0 and isinstance(fields[0], (list, tuple)):
-                parsed_fields.update(fields)
+                parsed_fields.update((tuple(x), None) for x in fields)
             else:
-                parsed_fields.update([(x, None) for x in fields])
+                parsed_fields.update(((x, None), None) for x in fields)
 
             # Does not support field.attname.
             field_names = set(field.name for field in self.model._meta.fields if not field.primary_key)
-            non_model_fields = set(x[0] for x in parsed_fields).difference(field_names)
+            non_model_fields = [x[0] for x in parsed_fields if x[0] not in field_names]
             if non_model_fields:
                 raise ValueError("The following fields do not exist in this"
                                  " model: {0}".format(", ".join(x for x in non_model_fields)))
         else:
-            parsed_fields.update(self._find_text_fields())
+            parsed_fields.update((x, None) for x in self._find_text_fields())
 
-        return parsed_fields
+        return tuple(parsed_fields)
 
     def _get_search_vector(self, configs, using, fields=None, extra=None):
+        """
+        Return the SQL expression of the search vector. It is compiled once
+        for each set of arguments, unless they are not hashable (once frozen,
+        lists and dicts are).
+        """
+        if fields is None:
+            # Same key for the default fields, however they are given.
+            fields = self._fields
+
+        try:
+            key = (self.model, _freeze(configs), using, _freeze(fields), _freeze(extra))
+            search_vector = self._search_vectors.get(key)
+        except TypeError:
+            key = search_vector = None
+
+        if search_vector is None:
+            search_vector = self._compile_search_vector(configs, using, fields, extra)
+            if key is not None:
+                self._search_vectors[key] = search_vector
+
+        return search_vector
+
+    def _compile_search_vector(self, configs, using, fields=None, extra=None):
         if fields is None:
             vector_fields = self._parse_fields(self._fields)
         else:
@@ -262,7 +1100,65 @@ class SearchManagerMixIn(object):
                (config, qn(field.model._meta.db_table), qn(field.column), weight)
 
 
+def get_prepared_statement(connection, sql):
+    """
+    Return the name of a server-side prepared statement for `sql` (a query
+    with %s placeholders) on `connection`, preparing it if needed.
+
+    The statements are remembered per database session, and the least
+    recently used ones are deallocated to keep at most
+    settings.PGFULLTEXT_PREPARED_STATEMENTS (100 by default) of them.
+    """
+    connection.ensure_connection()
+
+    # Prepared statements live as long as the session, forget them on reconnection.
+    session, statements = getattr(connection, '_fts_prepared_statements', (None, None))
+    if session is not connection.connection:
+        statements = OrderedDict()
+        connection._fts_prepared_statements = (connection.connection, statements)
+
+    name = statements.pop(sql, None)
+    if name is None:
+        name = 'fts_%s' % hashlib.md5(force_bytes(sql)).hexdigest()
+
+        placeholders = iter(range(1, sql.count('%s') + 1))
+        statement = re.sub(r'%%|%s', lambda m: '%' if m.group() == '%%' else '$%d' % next(placeholders), sql)
+
+        cursor = connection.cursor()
+        cursor.execute("PREPARE %s AS %s" % (name, statement))
+
+        limit = getattr(settings, 'PGFULLTEXT_PREPARED_STATEMENTS', 100)
+        while len(statements) >= limit:
+            cursor.execute("DEALLOCATE %s" % statements.popitem(last=False)[1])
+
+    statements[sql] = name
+    return name
+
+
+def _get_array_literal(values):
+    """
+    Return the text of a PostgreSQL array holding `values`. Unlike lists,
+    it can be given as a parameter of the extra select used in order_by,
+    which are hashed by Django.
+    """
+    return u'{%s}' % u','.join(
+        u'"%s"' % smart_text(x).replace(u'\\', u'\\\\').replace(u'"', u'\\"') for x in values
+    )
+
+
+def _get_headline_options(options):
+    """
+    Return the options string of ts_headline for a dict of options.
+    """
+    if isinstance(options, dict):
+        return u', '.join(u'%s=%s' % (key, options[key]) for key in sorted(options))
+    return options
+
+
 class SearchQuerySet(QuerySet):
+    # Lazy headline, see with_headlines.
+    _fts_headline = None
+
     @property
     def manager(self):
         return self.model._fts_manager
@@ -273,7 +1169,8 @@ class SearchQuerySet(QuerySet):
 
     def search(self, query, rank_field=None, rank_function='ts_rank', config=None,
                rank_normalization=32, raw=False, using=None, fields=None,
-               headline_field=None, headline_document=None):
+               headline_field=None, headline_document=None, cache=False,
+               rank_weights=None, rank_boost_field=None, headline_options=None, lazy_headline=False):
         '''
         Convert query with to_tsquery or plainto_tsquery, depending on raw is
         `True` or `False`, and return a QuerySet with the filter.
@@ -284,6 +1181,12 @@ class SearchQuerySet(QuerySet):
 
         http://www.postgresql.org/docs/9.1/interactive/textsearch-controls.html#TEXTSEARCH-RANKING
 
+        The weights of the A, B, C and D labels can be given in rank_weights,
+        either as a dict like {'A': 1.0, 'B': 0.5} (missing labels keep their
+        default weight) or as a list in the PostgreSQL order: D, C, B, A.
+        The rank is multiplied by the value of the rank_boost_field, which
+        defaults to the one of the manager.
+
         If an empty query is given, no filter is made so the QuerySet will
         return all model instances.
 
@@ -292,68 +1195,493 @@ class SearchQuerySet(QuerySet):
 
         If `headline_field` and `headline_document` is not `None`, a field with
         this `headline_field` name will be added containing the headline of the
-        instances, which will be searched inside `headline_document`.
+        instances, which will be searched inside `headline_document`, with
+        the headline_options (see with_headlines). With lazy_headline=True,
+        the headlines are computed by with_headlines, only for the fetched
+        instances.
 
         Search headlines are explained here:
         http://www.postgresql.org/docs/9.1/static/textsearch-controls.html#TEXTSEARCH-HEADLINE
+
+        If `cache` is True, the keys (and ranks) of the results are read from
+        the cache, or stored there for the cache_timeout of the manager. The
+        returned queryset then selects those rows by key, in the same order.
+        Searches with more than settings.PGFULLTEXT_CACHE_MAX_RESULTS (1000
+        by default) results are not cached. The cache key is made of the
+        query, lowercased and with its spaces normalized, the search options
+        and the SQL of this queryset. The cache is read, and on a miss the
+        search is run, by this call rather than when the queryset is
+        evaluated, since the returned queryset is built from the keys.
         '''
 
         if not config:
             config = self.manager.config
 
         db_alias = using if using is not None else self.db
-        connection = connections[db_alias]
-        qn = connection.ops.quote_name
 
         qs = self
         if using is not None:
             qs = qs.using(using)
 
-        if query:
-            function = "to_tsquery" if raw else "plainto_tsquery"
-            ts_query = smart_text(
-                "%s('%s', %s)" % (function, config, adapt(query))
-            )
-
-            full_search_field = "%s.%s" % (
-                qn(self.model._meta.db_table),
-                qn(self.manager.search_field)
-            )
-
-            # if fields is passed, obtain a vector expression with
-            # these fields. In other case, intent use of search_field if
-            # exists.
-            if fields:
-                search_vector = self.manager._get_search_vector(config, using, fields=fields)
-            else:
-                if not self.manager.search_field:
-                    raise ValueError("search_field is not specified")
+        if query and cache:
+            search_options = dict(rank_function=rank_function, config=config, rank_normalization=rank_normalization,
+                                  raw=raw, fields=fields, rank_weights=rank_weights,
+                                  rank_boost_field=rank_boost_field)
+            qs = qs._get_cached_search(query, rank_field, search_options)
 
-                search_vector = full_search_field
+        elif query:
+            ts_query, ts_param = self._get_ts_query(config, raw, smart_text(query), db_alias)
+            search_vector = self._get_search_vector_sql(config, db_alias, fields)
 
             where = " (%s) @@ (%s)" % (search_vector, ts_query)
-            select_dict, order = {}, []
+            select_dict, select_params, order = OrderedDict(), [], []
 
             if rank_field:
-                select_dict[rank_field] = '%s(%s, %s, %d)' % (
-                    rank_function,
-                    search_vector,
-                    ts_query,
-                    rank_normalization
+                select_dict[rank_field] = self._get_rank_sql(
+                    rank_function, search_vector, ts_query, rank_normalization, rank_weights, rank_boost_field,
+                    db_alias
                 )
+                select_params.append(ts_param)
                 order = ['-%s' % (rank_field,)]
 
-            if headline_field is not None and headline_document is not None:
-                select_dict[headline_field] = "ts_headline('%s', %s, %s)" % (
-                    config,
-                    headline_document,
-                    ts_query
-                )
+            qs = qs.extra(select=select_dict, select_params=select_params, where=[where], params=[ts_param],
+                          order_by=order)
+
+        if query and headline_field is not None and headline_document is not None:
+            qs = qs.with_headlines(headline_field, headline_document, query, config=config, raw=raw,
+                                   options=headline_options, lazy=lazy_headline)
+
+        return qs
 
-            qs = qs.extra(select=select_dict, where=[where], order_by=order)
+    def with_headlines(self, headline_field, headline_document, query, config=None, raw=False, options=None,
+                       lazy=True):
+        """
+        Return a queryset whose instances have in `headline_field` the
+        headline of the query found in `headline_document`, an SQL expression
+        on the columns of the table such as a column name.
+
+        The headlines options (MaxWords, MinWords, MaxFragments...) can be
+        given in `options`, either as a dict or as a string.
+
+        If `lazy` is True, headlines are not computed by the query of the
+        queryset but by a second one, made once its instances are fetched,
+        for them only. So when paginating, only the headlines of the page are
+        computed, however many rows match. They are not computed for values()
+        or iterator().
+        """
+        if not config:
+            config = self.manager.config
+
+        headline = (headline_field, headline_document, smart_text(query), config, raw, _get_headline_options(options))
+        if lazy:
+            qs = self._clone()
+            qs._fts_headline = headline
+            return qs
+
+        select_sql, select_params = self._get_headline_sql(headline, self.db)
+        return self.extra(select={headline_field: select_sql}, select_params=select_params)
 
+    def _get_headline_sql(self, headline, using):
+        headline_field, headline_document, query, config, raw, options = headline
+        ts_query, ts_param = self._get_ts_query(config, raw, query, using)
+
+        if options:
+            return "ts_headline('%s', %s, %s, %%s)" % (config, headline_document, ts_query), [ts_param, options]
+        return "ts_headline('%s', %s, %s)" % (config, headline_document, ts_query), [ts_param]
+
+    def _clone(self, *args, **kwargs):
+        qs = super(SearchQuerySet, self)._clone(*args, **kwargs)
+        qs._fts_headline = self._fts_headline
         return qs
 
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(SearchQuerySet, self)._fetch_all()
+        if fetched and self._fts_headline is not None:
+            self._add_headlines(self._result_cache)
+
+    def _add_headlines(self, objects):
+        """
+        Compute the lazy headlines of `objects` in one query.
+        """
+        objects = [x for x in objects if isinstance(x, self.model)]
+        if not objects:
+            return
+
+        qn = connections[self.db].ops.quote_name
+        pk = self.model._meta.pk
+        select_sql, params = self._get_headline_sql(self._fts_headline, self.db)
+
+        cursor = connections[self.db].cursor()
+        cursor.execute("SELECT %s, %s FROM %s WHERE %s = ANY(%%s)" % (
+            qn(pk.column), select_sql, qn(self.model._meta.db_table), qn(pk.column)
+        ), params + [[x.pk for x in objects]])
+        headlines = dict((pk.to_python(x), headline) for x, headline in cursor.fetchall())
+
+        for obj in objects:
+            setattr(obj, self._fts_headline[0], headlines.get(obj.pk))
+
+    def _get_cached_search(self, query, rank_field, search_options):
+        """
+        Run search() reading the ranked keys of the results from the cache,
+        or storing them there.
+        """
+        timeout = self.manager.cache_timeout
+        if timeout is None:
+            raise ValueError("The search manager of %s has no cache_timeout" % self.model.__name__)
+
+        query = smart_text(query)
+        config, raw = search_options['config'], search_options['raw']
+        rank_options = ('rank_function', 'rank_normalization', 'rank_weights', 'rank_boost_field')
+
+        try:
+            sql, params = self.query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return self.none()
+
+        # Searches differing only in case or spacing match the same rows.
+        normalized_query = u' '.join(query.lower().split())
+        digest = hashlib.md5(force_bytes(repr((
+            normalized_query, config, search_options['fields'], raw,
+            rank_field and [_freeze(search_options[x]) for x in rank_options],
+            self.db, sql, params
+        )))).hexdigest()
+        key = 'pgfulltext:search:%s:%s:%s' % (
+            self.model._meta.db_table, get_search_cache_generation(self.model), digest
+        )
+
+        cache = get_search_cache()
+        results = cache.get(key)
+        if results is None:
+            max_results = getattr(settings, 'PGFULLTEXT_CACHE_MAX_RESULTS', 1000)
+            matches = self.search(query, rank_field=rank_field, **search_options)
+            if rank_field:
+                results = list(matches.values_list('pk', rank_field)[:max_results + 1])
+            else:
+                results = [(pk,) for pk in matches.values_list('pk', flat=True)[:max_results + 1]]
+
+            if len(results) > max_results:
+                return self.search(query, rank_field=rank_field, **search_options)
+
+            cache.set(key, results, timeout)
+
+        qn = connections[self.db].ops.quote_name
+        pks = _get_array_literal(x[0] for x in results)
+        position = "array_position(%%s::text[], %s.%s::text)" % (
+            qn(self.model._meta.db_table), qn(self.model._meta.pk.column)
+        )
+
+        select_dict, select_params = OrderedDict(), []
+        select_dict['_fts_position'] = position
+        select_params.append(pks)
+
+        if rank_field:
+            select_dict[rank_field] = "(%%s::real[])[%s]" % position
+            select_params.extend([_get_array_literal(x[1] for x in results), pks])
+
+        return self.filter(pk__in=[x[0] for x in results]).extra(
+            select=select_dict, select_params=select_params, order_by=['_fts_position']
+        )
+
+    def search_top(self, query, limit=20, candidates=None, rank_field='rank', rank_function='ts_rank',
+                   config=None, rank_normalization=32, raw=False, using=None, fields=None, rum=None,
+                   rank_weights=None, rank_boost_field=None):
+        '''
+        Return the `limit` best ranked instances matching the query, with
+        their rank in `rank_field`, without ranking every matching row like
+        search() does.
+
+        The rows are found in two steps: at most `candidates` matching rows
+        are picked through the text search index, in no particular order,
+        then only those are ranked and sorted. When there are no more matches
+        than candidates, the result is the same as the one of search();
+        otherwise it is the top of a sample of the matches, so raising
+        `candidates` trades speed for accuracy. It defaults to
+        settings.PGFULLTEXT_TOP_CANDIDATES (1000).
+
+        If the search_field has a RUM index (VectorField(index_type='rum')),
+        the index instead returns the matching rows already ordered by their
+        distance to the query (the <=> operator), which is exact and only
+        reads `limit` rows, but ignores the rank options. Pass rum=True or
+        rum=False to choose the strategy instead of deciding from the index
+        type.
+        '''
+        if not config:
+            config = self.manager.config
+
+        db_alias = using if using is not None else self.db
+
+        qs = self
+        if using is not None:
+            qs = qs.using(using)
+
+        if not query:
+            return qs[:limit]
+
+        if rum is None:
+            rum = not fields and self._get_search_index_type() == 'rum'
+        elif rum and fields:
+            raise ValueError("RUM ordering needs the search_field, not fields")
+
+        query = smart_text(query)
+        ts_query, ts_param = self._get_ts_query(config, raw, query, db_alias)
+        search_vector = self._get_search_vector_sql(config, db_alias, fields)
+
+        select_dict = OrderedDict()
+        select_dict[rank_field] = self._get_rank_sql(
+            rank_function, search_vector, ts_query, rank_normalization, rank_weights, rank_boost_field, db_alias
+        )
+
+        if rum:
+            distance_field = '%s_distance' % rank_field
+            select_dict[distance_field] = '(%s) <=> (%s)' % (search_vector, ts_query)
+            qs = qs.extra(select=select_dict, select_params=[ts_param, ts_param],
+                          where=[" (%s) @@ (%s)" % (search_vector, ts_query)], params=[ts_param],
+                          order_by=[distance_field, '-%s' % rank_field])
+        else:
+            if candidates is None:
+                candidates = getattr(settings, 'PGFULLTEXT_TOP_CANDIDATES', 1000)
+
+            # Any order in the candidates subquery would sort every match.
+            matches = qs.search(query, config=config, raw=raw, fields=fields).order_by().values('pk')
+            try:
+                # Compiled on its own, so the search expression refers to the
+                # table of the subquery and not to the outer one.
+                matches_sql, matches_params = matches[:max(candidates, limit)].query.get_compiler(db_alias).as_sql()
+            except EmptyResultSet:
+                return qs.none()
+
+            qn = connections[db_alias].ops.quote_name
+            where = "%s.%s IN (%s)" % (qn(self.model._meta.db_table), qn(self.model._meta.pk.column), matches_sql)
+            qs = qs.extra(select=select_dict, select_params=[ts_param], where=[where], params=list(matches_params),
+                          order_by=['-%s' % rank_field])
+
+        return qs[:limit]
+
+    def estimated_count(self, max_exact=None):
+        """
+        Return the number of rows of this queryset, without counting all of
+        them when there are many.
+
+        Up to `max_exact` rows (settings.PGFULLTEXT_MAX_EXACT_COUNT, 1000 by
+        default) are counted, so small results get an exact count; beyond
+        that, the number of rows estimated by the planner (EXPLAIN) is
+        returned, which is never lower than the rows already counted but
+        can be far from the real count, above or below it.
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache)
+
+        if self.query.low_mark or self.query.high_mark is not None:
+            # A slice already bounds the count.
+            return self.count()
+
+        if max_exact is None:
+            max_exact = getattr(settings, 'PGFULLTEXT_MAX_EXACT_COUNT', 1000)
+
+        qs = self.order_by().values('pk')
+        try:
+            sql, params = qs[:max_exact + 1].query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return 0
+
+        cursor = connections[self.db].cursor()
+        cursor.execute("SELECT count(*) FROM (%s) AS capped" % sql, params)
+        count = cursor.fetchone()[0]
+        if count <= max_exact:
+            return count
+
+        sql, params = qs.query.get_compiler(self.db).as_sql()
+        cursor.execute("EXPLAIN (FORMAT JSON) %s" % sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, six.string_types):
+            plan = json.loads(plan)
+
+        return max(count, int(plan[0]['Plan']['Plan Rows']))
+
+    def _get_rank_sql(self, rank_function, search_vector, ts_query, rank_normalization, rank_weights,
+                      rank_boost_field, using):
+        """
+        Return the rank expression of the searches, see search().
+        """
+        weights = ''
+        if rank_weights is not None:
+            if isinstance(rank_weights, dict):
+                rank_weights = [rank_weights.get(x, DEFAULT_RANK_WEIGHTS[x]) for x in 'DCBA']
+            if len(rank_weights) != 4:
+                raise ValueError("rank_weights must have 4 weights, for the D, C, B and A labels")
+            weights = "'{%s}'::float4[], " % ', '.join(repr(float(x)) for x in rank_weights)
+
+        rank = '%s(%s%s, %s, %d)' % (rank_function, weights, search_vector, ts_query, rank_normalization)
+
+        if rank_boost_field is None:
+            rank_boost_field = self.manager.rank_boost_field
+        if rank_boost_field:
+            qn = connections[using].ops.quote_name
+            rank = '%s * coalesce(%s.%s, 1)' % (
+                rank, qn(self.model._meta.db_table), qn(self.model._meta.get_field(rank_boost_field).column)
+            )
+
+        return rank
+
+    def _get_ts_query(self, config, raw, query, using):
+        """
+        Return the (sql, param) pair of the tsquery of `query`. The query is
+        a parameter, so every search of the same shape has the same SQL text,
+        whatever the searched words are. With a tsquery cache (see
+        get_normalized_tsquery), the param is the already parsed tsquery.
+        """
+        function = "to_tsquery" if raw else "plainto_tsquery"
+        if get_tsquery_cache_size():
+            return "%s::tsquery", get_normalized_tsquery(function, config, query, using)
+        return "%s('%s', %%s)" % (function, config), query
+
+    def _get_search_vector_sql(self, config, using, fields=None):
+        """
+        Return the vector searched: an expression built from `fields` if
+        given, or else the search_field.
+        """
+        if fields:
+            return self.manager._get_search_vector(config, using, fields=fields)
+
+        if not self.manager.search_field:
+            raise ValueError("search_field is not specified")
+
+        return "%s.%s" % (
+            connections[using].ops.quote_name(self.model._meta.db_table),
+            connections[using].ops.quote_name(self.manager.search_field)
+        )
+
+    def _get_search_index_type(self):
+        if not self.manager.search_field:
+            return None
+        try:
+            field = self.model._meta.get_field(self.manager.search_field)
+        except FieldDoesNotExist:
+            return None
+        return getattr(field, 'index_type', None)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Create the objects like QuerySet.bulk_create, and their search_field
+        if it is updated automatically: the INSERT computes the vectors from
+        the values of the objects, like the inline automatic update, or when
+        the model has its own _convert_field_to_db, one more statement updates
+        the created rows (Django >= 1.10, which sets their primary keys).
+        """
+        manager = self.manager
+        if not manager._updates_search_field():
+            return super(SearchQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+        objs = list(objs)
+        inline = not hasattr(self.model, '_convert_field_to_db')
+        if inline:
+            attname = self.model._meta.get_field(manager.search_field).attname
+            for obj in objs:
+                setattr(obj, attname, manager._get_inline_search_vector(obj))
+
+        try:
+            objs = super(SearchQuerySet, self).bulk_create(objs, *args, **kwargs)
+        finally:
+            if inline:
+                for obj in objs:
+                    setattr(obj, attname, '')
+
+        if not inline:
+            pks = [obj.pk for obj in objs if obj.pk is not None]
+            if pks:
+                manager.update_search_field(pk=pks, using=self.db)
+        elif manager.cache_timeout is not None:
+            invalidate_search_cache(self.model, self.db)
+
+        return objs
+
+    if hasattr(QuerySet, 'bulk_update'):
+        def bulk_update(self, objs, fields, *args, **kwargs):
+            """
+            Update the objects like QuerySet.bulk_update, then their
+            search_field with one statement if any searched field changed.
+            """
+            objs = list(objs)
+            result = super(SearchQuerySet, self).bulk_update(objs, fields, *args, **kwargs)
+
+            manager = self.manager
+            if manager._updates_search_field() and manager._search_fields_updated(fields) and objs:
+                manager.update_search_field(pk=[obj.pk for obj in objs], using=self.db)
+
+            return result
+
+    def update(self, **kwargs):
+        """
+        Update the rows like QuerySet.update, then their search_field with
+        one statement if any searched field changed. The keys of the updated
+        rows are returned by the UPDATE itself, since the filter may not match
+        them afterwards, so the search_field of exactly these rows is updated.
+        """
+        manager = self.manager
+        if not manager._updates_search_field() or not manager._search_fields_updated(kwargs):
+            return super(SearchQuerySet, self).update(**kwargs)
+
+        assert self.query.can_filter(), "Cannot update a query once a slice has been taken."
+        self._for_write = True
+        query = self.query.clone(sql.UpdateQuery)
+        query.add_update_values(kwargs)
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+
+        with atomic(using=self.db):
+            if query.related_updates:
+                # Updates of parent models are made by Django with the keys read
+                # first: lock the same rows before, so no other ones are updated.
+                pks = list(self.select_for_update().values_list('pk', flat=True))
+                rows = QuerySet(self.model, using=self.db).filter(pk__in=pks).update(**kwargs)
+            else:
+                try:
+                    update_sql, params = query.get_compiler(self.db).as_sql()
+                except EmptyResultSet:
+                    return 0
+
+                cursor = connection.cursor()
+                cursor.execute("%s RETURNING %s.%s" % (
+                    update_sql, qn(self.model._meta.db_table), qn(self.model._meta.pk.column)
+                ), params)
+                pks = [x[0] for x in cursor.fetchall()]
+                rows = len(pks)
+
+            if pks:
+                # Sent as a single array parameter, whatever the number of rows.
+                manager.update_search_field(pk=pks, using=self.db)
+
+        self._result_cache = None
+        return rows
+    update.alters_data = True
+
+    def prepared(self):
+        """
+        Run this queryset as a server-side prepared statement, prepared once
+        per database connection for each distinct SQL text (that is, for each
+        search shape, since the query words are parameters), and return its
+        results as a RawQuerySet.
+
+        Only the columns of the model and the extra select fields (such as
+        the rank and headline ones) are read, so select_related is not
+        supported. It is not usable behind connection poolers that do not
+        keep sessions, like pgbouncer in transaction mode.
+        """
+        try:
+            sql, params = self.query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return self.none()
+
+        name = get_prepared_statement(connections[self.db], sql)
+        if params:
+            execute_sql = "EXECUTE %s(%s)" % (name, ", ".join(repeat("%s", len(params))))
+        else:
+            execute_sql = "EXECUTE %s" % name
+
+        return RawQuerySet(execute_sql, model=self.model, params=params, using=self.db)
+
 
 class SearchManager(SearchManagerMixIn, models.Manager):
     pass
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Migration operations for Django >= 1.7.
+"""
+import warnings
+
+from django.apps import apps
+from django.db.migrations.operations.base import Operation
+
+
+def get_search_manager(app_label, model_name):
+    # Models of the migration states have no custom managers, the search
+    # manager is read from the current model.
+    return apps.get_model(app_label, model_name)._fts_manager
+
+
+class CreateSearchTrigger(Operation):
+    """
+    Create a trigger keeping the search_field of a model up to date, built
+    from `fields` and `config` (by default, the ones of its search manager).
+    The function and triggers are named after `name`, by default the table
+    and the search_field.
+
+        operations = [
+            CreateSearchTrigger('Page', fields=('name', 'description'), name='page_search'),
+        ]
+
+    The search manager is the one of the model when the migration runs:
+    give the fields, config and name so the migration keeps creating the
+    same trigger, whatever the manager becomes later.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, search_field=None, fields=None, config=None, name=None):
+        self.model_name = model_name
+        self.search_field = search_field
+        self.fields = fields
+        self.config = config
+        self.name = name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        manager = get_search_manager(app_label, self.model_name)
+        for sql in manager.get_search_trigger_sql(search_field=self.search_field, fields=self.fields,
+                                                  config=self.config, using=schema_editor.connection.alias,
+                                                  name=self.name):
+            schema_editor.execute(sql, params=None)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        manager = get_search_manager(app_label, self.model_name)
+        for sql in manager.get_drop_search_trigger_sql(search_field=self.search_field,
+                                                       using=schema_editor.connection.alias, name=self.name):
+            schema_editor.execute(sql, params=None)
+
+    def describe(self):
+        return "Create search trigger for %s" % self.model_name
+
+
+class ConcurrentOperation(Operation):
+    """
+    Base class of operations that may run concurrent index builds.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _can_run_concurrently(self, schema_editor):
+        if not self.concurrently:
+            return False
+
+        if schema_editor.connection.in_atomic_block:
+            warnings.warn(
+                "%s is run without CONCURRENTLY because the migration runs in a transaction." % self.describe()
+            )
+            return False
+
+        return True
+
+
+class CreateSearchIndex(ConcurrentOperation):
+    """
+    Create the text search index declared by a VectorField (see its
+    index_type, fastupdate and gin_pending_list_limit arguments).
+
+        operations = [
+            CreateSearchIndex('Page', 'search_index'),
+        ]
+
+    By default the index is built with CREATE INDEX CONCURRENTLY, so the
+    table is not locked against writes. That cannot run in a transaction:
+    set atomic = False on the migration (Django >= 1.10), otherwise the
+    index is built without CONCURRENTLY.
+    """
+
+    def __init__(self, model_name, name, concurrently=True):
+        self.model_name = model_name
+        self.name = name
+        self.concurrently = concurrently
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        field = to_state.apps.get_model(app_label, self.model_name)._meta.get_field(self.name)
+        schema_editor.execute(
+            field.get_search_index_sql(schema_editor.connection, self._can_run_concurrently(schema_editor)),
+            params=None
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        field = from_state.apps.get_model(app_label, self.model_name)._meta.get_field(self.name)
+        schema_editor.execute(
+            field.get_drop_search_index_sql(schema_editor.connection, self._can_run_concurrently(schema_editor)),
+            params=None
+        )
+
+    def describe(self):
+        return "Create search index on %s.%s" % (self.model_name, self.name)
+
+
+class CreateSearchExpressionIndex(ConcurrentOperation):
+    """
+    Create a GIN index on the vector expression built by the search manager
+    of a model from `fields` and `config` (by default, the ones of the
+    manager), which serves search(fields=...) without a search_field.
+
+        operations = [
+            CreateSearchExpressionIndex('Page', fields=('name', 'description'), name='page_name_description_fts'),
+        ]
+
+    As CreateSearchIndex, it is built with CREATE INDEX CONCURRENTLY. The
+    index is named `name`, by default after the table, the fields and a hash
+    of the fields and config: give it, so the index is dropped by its name
+    even if the manager changes after the migration is written.
+    """
+
+    def __init__(self, model_name, fields=None, config=None, concurrently=True, name=None):
+        self.model_name = model_name
+        self.fields = fields
+        self.config = config
+        self.concurrently = concurrently
+        self.name = name
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        manager = get_search_manager(app_label, self.model_name)
+        schema_editor.execute(manager.get_search_expression_index_sql(
+            fields=self.fields,
+            config=self.config,
+            using=schema_editor.connection.alias,
+            concurrently=self._can_run_concurrently(schema_editor),
+            name=self.name
+        ), params=None)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        manager = get_search_manager(app_label, self.model_name)
+        schema_editor.execute(manager.get_drop_search_expression_index_sql(
+            fields=self.fields,
+            config=self.config,
+            using=schema_editor.connection.alias,
+            concurrently=self._can_run_concurrently(schema_editor),
+            name=self.name
+        ), params=None)
+
+    def describe(self):
+        return "Create search expression index on %s" % self.model_name
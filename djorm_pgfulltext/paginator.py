@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from django.core.paginator import EmptyPage, Page, Paginator
+
+
+class SearchPage(Page):
+    """
+    A page of a SearchPaginator, knowing whether rows follow it when it is
+    near the estimated end.
+    """
+
+    has_more = None
+
+    def has_next(self):
+        if self.has_more is not None:
+            return self.has_more
+        return super(SearchPage, self).has_next()
+
+    def end_index(self):
+        if self.has_more is not None:
+            return self.start_index() + len(self.object_list) - 1
+        return super(SearchPage, self).end_index()
+
+
+class SearchPaginator(Paginator):
+    """
+    A Paginator counting its object list with estimated_count() (see
+    SearchQuerySet), so broad searches do not pay for an exact count.
+
+    As the number of pages of big results is estimated, it can be too high,
+    and the last pages then hold fewer rows than expected, or none, or too
+    low: the pages after the estimated last one are still served as long as
+    they hold rows, and the last page is not cut at the estimated count.
+    Object lists without estimated_count are counted as usual.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, max_exact_count=None):
+        super(SearchPaginator, self).__init__(object_list, per_page, orphans=orphans,
+                                              allow_empty_first_page=allow_empty_first_page)
+        self.max_exact_count = max_exact_count
+        self._estimated_count = None
+
+    def _get_count(self):
+        if self._estimated_count is None:
+            if hasattr(self.object_list, 'estimated_count'):
+                self._estimated_count = self.object_list.estimated_count(max_exact=self.max_exact_count)
+            else:
+                try:
+                    self._estimated_count = self.object_list.count()
+                except (AttributeError, TypeError):
+                    # The object list is not a QuerySet, or count() needs arguments (a list).
+                    self._estimated_count = len(self.object_list)
+        return self._estimated_count
+    count = property(_get_count)
+
+    def validate_number(self, number):
+        try:
+            return super(SearchPaginator, self).validate_number(number)
+        except EmptyPage:
+            number = int(number)
+            if number > 1 and self.object_list[(number - 1) * self.per_page:][:1]:
+                return number
+            raise
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans < self.count:
+            return SearchPage(self.object_list[bottom:top], number, self)
+
+        # Around the estimated end, read one row more than the page and its
+        # orphans to know whether the rows really end there.
+        object_list = list(self.object_list[bottom:top + self.orphans + 1])
+        has_more = len(object_list) > self.per_page + self.orphans
+        if has_more:
+            object_list = object_list[:self.per_page]
+
+        page = SearchPage(object_list, number, self)
+        page.has_more = has_more
+        return page
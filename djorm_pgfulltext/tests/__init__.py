@@ -2,14 +2,18 @@
 
 import django
 from django.db import transaction
-from django.utils.unittest import TestCase
+from django.utils.unittest import TestCase, skipIf
 
+from djorm_pgfulltext.models import on_commit
 from djorm_pgfulltext.tests.models import Book
 from djorm_pgfulltext.tests.models import Person
 from djorm_pgfulltext.tests.models import Person2
 from djorm_pgfulltext.tests.models import Person3
 from djorm_pgfulltext.tests.models import Person4
 from djorm_pgfulltext.tests.models import Person5
+from djorm_pgfulltext.tests.models import Person6
+from djorm_pgfulltext.tests.models import Person7
+from djorm_pgfulltext.tests.models import Person8
 
 
 class FtsSetUpMixin:
@@ -126,6 +130,18 @@ class TestFts(FtsSetUpMixin, TestCase):
 
         self.assertEqual(qs[0].headline, 'Learning <b>Python</b>')
 
+    def test_search_parameters(self):
+        def search(query):
+            return Person.objects.search(query, rank_field='rank', headline_field='headline',
+                                         headline_document='name')
+
+        sql1, params1 = search(u"Andrei").query.sql_with_params()
+        sql2, params2 = search(u"'Andréi' python%").query.sql_with_params()
+
+        self.assertEqual(sql1, sql2)
+        self.assertEqual(list(params2), [u"'Andréi' python%"] * 3)
+        self.assertEqual(search(u"'Andréi' python%")[0].headline, u'<b>Andréi</b>')
+
     def test_multi_vector_field(self):
         Person4.objects.create(
             name=u'Pepa',
@@ -189,3 +205,858 @@ class TestFullTextLookups(FtsSetUpMixin, TestCase):
 
         # make sure it is preserved after re-query
         self.assertEquals(pq.all()[0].pk, self.p1.pk)
+
+
+class TestUpdateSearchField(TestCase):
+    def setUp(self):
+        self.objs = [
+            Person2.objects.create(name=u'Batched%d' % i, description=u"Is reindexed")
+            for i in range(5)
+        ]
+
+    def tearDown(self):
+        Person2.objects.filter(pk__in=[x.pk for x in self.objs]).delete()
+
+    def test_batched_update(self):
+        calls = []
+        Person2.objects.update_search_field(batch_size=2, progress=lambda rows, pk: calls.append((rows, pk)))
+
+        total = Person2.objects.count()
+        self.assertEqual(len(calls), (total + 1) // 2)
+        self.assertEqual(calls[-1], (total, Person2.objects.order_by('-pk')[0].pk))
+
+        qs = Person2.objects.search(query="reindexed")
+        self.assertEqual(qs.count(), 5)
+
+    def test_batched_update_with_pks(self):
+        pks = [x.pk for x in self.objs[:3]]
+        calls = []
+        Person2.objects.update_search_field(pk=pks, batch_size=2, progress=lambda rows, pk: calls.append((rows, pk)))
+
+        self.assertEqual(calls, [(2, pks[1]), (3, pks[2])])
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 3)
+
+    def test_batched_update_uuid_pk(self):
+        Person7.objects.all().delete()
+        objs = [Person7.objects.create(name=u'Batched%d' % i, description=u"Is reindexed") for i in range(5)]
+        pks = sorted(x.pk for x in objs)
+
+        calls = []
+        result = Person7.objects.update_search_field(batch_size=2, progress=lambda rows, pk: calls.append((rows, pk)))
+        self.assertEqual(result.updated, 5)
+        self.assertEqual(calls, [(2, pks[1]), (4, pks[3]), (5, pks[4])])
+        self.assertEqual(Person7.objects.search(query="reindexed").count(), 5)
+
+    def test_update_queryset_pk(self):
+        pks = [x.pk for x in self.objs]
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+
+        result = Person2.objects.update_search_field(pk=Person2.objects.filter(pk__in=pks[:4]), batch_size=3,
+                                                     queryset=Person2.objects.filter(pk__gt=pks[0]))
+        self.assertEqual(result.updated, 3)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 3)
+
+        self.assertEqual(Person2.objects.update_search_field(pk=[]).updated, 0)
+
+    def test_update_string_pks(self):
+        pks = [x.pk for x in self.objs]
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+
+        self.assertEqual(Person2.objects.update_search_field(pk=str(pks[0])).updated, 1)
+        self.assertEqual(Person2.objects.update_search_field(pk=[str(x) for x in pks[1:3]]).updated, 2)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 3)
+
+        Person7.objects.all().delete()
+        obj = Person7.objects.create(name=u'Uuid', description=u"Is reindexed")
+        Person7.objects.all().update(search_index='')
+        self.assertEqual(Person7.objects.update_search_field(pk=[str(obj.pk)]).updated, 1)
+
+    def test_update_only_changed(self):
+        pks = [x.pk for x in self.objs]
+        result = Person2.objects.update_search_field(pk=pks)
+        self.assertEqual(result, (5, 0))
+
+        Person2.objects.filter(pk=pks[0]).update(name=u'Changed')
+
+        result = Person2.objects.update_search_field(pk=pks, only_changed=True)
+        self.assertEqual(result, (1, 4))
+        self.assertEqual(Person2.objects.search(query="changed").count(), 1)
+
+        result = Person2.objects.update_search_field(pk=pks, only_changed=True, batch_size=2)
+        self.assertEqual(result, (0, 5))
+
+    def test_update_pk_range(self):
+        pks = [x.pk for x in self.objs]
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+
+        result = Person2.objects.update_search_field(pk_range=(pks[1], pks[3]), batch_size=2)
+        self.assertEqual(result.updated, 3)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 3)
+
+    def test_update_since_and_queryset(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        pks = [x.pk for x in self.objs]
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+        Person2.objects.filter(pk__in=pks[:3]).update(modified=timezone.now() - timedelta(days=2))
+
+        result = Person2.objects.update_search_field(since=timezone.now() - timedelta(days=1), batch_size=2)
+        self.assertEqual(result.updated, Person2.objects.count() - 3)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 2)
+
+        result = Person2.objects.update_search_field(queryset=Person2.objects.filter(name=u'Batched0'))
+        self.assertEqual(result.updated, 1)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 3)
+
+        result = Person2.objects.update_search_field(queryset=Person2.objects.none())
+        self.assertEqual(result.updated, 0)
+
+        with self.assertRaises(ValueError):
+            Person3.objects.update_search_field(since=timezone.now())
+
+    def test_staged_update(self):
+        pks = [x.pk for x in self.objs]
+        Person2.objects.exclude(pk__in=pks).delete()
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(rows, last_pk):
+            # Rows changed after being staged get a fresh vector.
+            Person2.objects.filter(pk=pks[-1]).update(name=u'Changed')
+            raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            Person2.objects.update_search_field_staged(batch_size=2, progress=interrupt)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 2)
+
+        calls = []
+        result = Person2.objects.update_search_field_staged(
+            batch_size=2, stage_progress=lambda rows, pk: calls.append((rows, pk))
+        )
+        self.assertEqual(calls, [])
+        self.assertEqual(result.updated, 3)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 5)
+        self.assertEqual(Person2.objects.search(query="changed").count(), 1)
+
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regclass('djorm_pgfulltext_person2_search_index_staging')")
+        self.assertEqual(cursor.fetchone()[0], None)
+
+    def test_staged_update_uuid_pk(self):
+        Person7.objects.all().delete()
+        objs = [Person7.objects.create(name=u'Staged%d' % i, description=u"Is reindexed") for i in range(5)]
+        pks = sorted(x.pk for x in objs)
+
+        calls = []
+        result = Person7.objects.update_search_field_staged(
+            batch_size=2, stage_progress=lambda rows, pk: calls.append((rows, pk))
+        )
+        self.assertEqual(calls, [(2, pks[1]), (4, pks[3]), (5, pks[4])])
+        self.assertEqual(result.updated, 5)
+        self.assertEqual(Person7.objects.search(query="reindexed").count(), 5)
+
+    def call_command(self, *args, **kwargs):
+        import sys
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('update_search_field', 'djorm_pgfulltext', 'Person2', *args, **kwargs)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_resume(self):
+        from djorm_pgfulltext.management.commands.update_search_field import Checkpoint
+
+        pks = [x.pk for x in self.objs]
+        Person2.objects.exclude(pk__in=pks).delete()
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+
+        Checkpoint.create_table('default')
+        checkpoint = Checkpoint(Person2)
+        checkpoint.start()
+        checkpoint.save(2, pks[1], 100.0)
+
+        output = self.call_command(batch_size=2, resume=True)
+        self.assertIn("Resuming from pk %s (2 rows already updated)" % pks[1], output)
+        self.assertIn("5 rows updated (last pk: %s), " % pks[-1], output)
+        # The rows up to the saved last pk, included, are not updated again.
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 3)
+
+        checkpoint.load()
+        self.assertEqual((checkpoint.rows, checkpoint.last_pk, checkpoint.finished), (5, pks[-1], True))
+
+        output = self.call_command(batch_size=2, resume=True)
+        self.assertIn("Already done", output)
+
+        self.call_command(batch_size=2, workers=2)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 5)
+        checkpoint = Checkpoint(Person2, '2/2')
+        checkpoint.load()
+        self.assertEqual((checkpoint.last_pk, checkpoint.finished), (pks[-1], True))
+
+    def test_resume_workers(self):
+        from djorm_pgfulltext.management.commands.update_search_field import Checkpoint
+
+        pks = [x.pk for x in self.objs]
+        Person2.objects.exclude(pk__in=pks).delete()
+
+        # Fewer rows than workers: the table is split in 5 ranges.
+        self.call_command(batch_size=2, workers=8, only_changed=True)
+        checkpoints = Checkpoint.load_parts(Person2)
+        self.assertEqual([x.key[2] for x in checkpoints], ['%d/5' % x for x in range(1, 6)])
+        self.assertEqual([x.rows for x in checkpoints], [1] * 5)
+
+        output = self.call_command(batch_size=2, workers=8, resume=True)
+        self.assertEqual(output.count("Already done"), 5)
+
+    def test_only_changed_progress(self):
+        pks = [x.pk for x in self.objs]
+        Person2.objects.exclude(pk__in=pks).delete()
+        Person2.objects.update_search_field()
+        Person2.objects.filter(pk=pks[0]).update(search_index='')
+
+        # Skipped rows are progress too.
+        output = self.call_command(batch_size=2, only_changed=True)
+        self.assertIn("5 rows processed (last pk: %s)" % pks[-1], output)
+        self.assertIn("Done (1 rows updated, 4 skipped)", output)
+
+    def test_command_filters(self):
+        from django.core.management.base import CommandError
+
+        pks = [x.pk for x in self.objs]
+        Person2.objects.filter(pk__in=pks).update(search_index='')
+
+        output = self.call_command(first_pk=str(pks[1]), last_pk=str(pks[2]))
+        self.assertIn("Done (2 rows updated, 0 skipped)", output)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 2)
+
+        output = self.call_command(since='2000-01-01', last_pk=str(pks[-1]))
+        self.assertIn("Done (%d rows updated" % Person2.objects.filter(pk__lte=pks[-1]).count(), output)
+        self.assertEqual(Person2.objects.search(query="reindexed").count(), 5)
+
+        with self.assertRaises(CommandError):
+            self.call_command(since='yesterday')
+        with self.assertRaises(CommandError):
+            self.call_command(first_pk='first')
+        with self.assertRaises(CommandError):
+            self.call_command(first_pk=str(pks[1]), workers=2)
+
+    def test_split_pk_range(self):
+        ranges = Person2.objects._split_pk_range(3)
+
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+
+        rows = sum(Person2.objects.update_search_field(pk_range=x).updated for x in ranges)
+        self.assertEqual(rows, Person2.objects.count())
+
+        # Each range ends where the next one starts, so no key falls between them.
+        for previous, following in zip(ranges, ranges[1:]):
+            self.assertEqual(previous[1:], (following[0], False))
+
+    def test_split_uuid_pk_range(self):
+        Person7.objects.all().delete()
+        for i in range(5):
+            Person7.objects.create(name=u'Split%d' % i, description=u"Is reindexed")
+
+        ranges = Person7.objects._split_pk_range(2)
+        self.assertEqual(len(ranges), 2)
+
+        rows = sum(Person7.objects.update_search_field(pk_range=x, batch_size=2).updated for x in ranges)
+        self.assertEqual(rows, Person7.objects.count())
+
+
+@skipIf(on_commit is None, "Requires Django>=1.9")
+class TestDeferredUpdate(TestCase):
+    def setUp(self):
+        Person3._fts_manager.auto_update_on_commit = True
+
+    def tearDown(self):
+        Person3._fts_manager.auto_update_on_commit = False
+        Person3.objects.filter(description=u"Deferred").delete()
+
+    def test_deferred_update(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for name in (u'Alfa', u'Bravo', u'Charlie'):
+                    Person3.objects.create(name=name, description=u"Deferred")
+
+        updates = [x for x in queries.captured_queries if x['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+
+        qs = Person3.objects.search(query="deferred")
+        self.assertEqual(qs.count(), 3)
+
+    def test_rolled_back_update(self):
+        from djorm_pgfulltext.models import _deferred_updates
+
+        class RolledBack(Exception):
+            pass
+
+        with self.assertRaises(RolledBack):
+            with transaction.atomic():
+                Person3.objects.create(name=u'Alfa', description=u"Deferred")
+                raise RolledBack()
+
+        with transaction.atomic():
+            obj = Person3.objects.create(name=u'Bravo', description=u"Deferred")
+            self.assertEqual(_deferred_updates.pending['default'][1], {Person3: set([obj.pk])})
+
+        self.assertNotIn('default', _deferred_updates.pending)
+        self.assertEqual(Person3.objects.search(query="deferred").count(), 1)
+
+
+class TestTrackFieldChanges(TestCase):
+    def setUp(self):
+        self.obj = Book.objects.create(name=u'Tracked', author=Person.objects.create(name=u'Author'))
+
+    def tearDown(self):
+        self.obj.delete()
+        Person8.objects.all().delete()
+
+    def test_update_fields(self):
+        Book.objects.filter(pk=self.obj.pk).update(search_index='')
+
+        self.obj.save(update_fields=['author'])
+        self.assertEqual(Book.objects.search(query="tracked").count(), 0)
+
+        self.obj.save(update_fields=['name'])
+        self.assertEqual(Book.objects.search(query="tracked").count(), 1)
+
+    def test_track_field_changes(self):
+        created = Person8.objects.create(name=u'Tracked', description=u'Person')
+        Person8.objects.all().update(search_index='')
+
+        # The values are remembered when instances are saved, and loaded.
+        created.visits += 1
+        created.save()
+        obj = Person8.objects.get(pk=created.pk)
+        obj.visits += 1
+        obj.save()
+        self.assertEqual(Person8.objects.search(query="tracked").count(), 0)
+
+        obj.name = u'Changed'
+        obj.save()
+        self.assertEqual(Person8.objects.search(query="changed").count(), 1)
+
+        Person8.objects.all().update(search_index='')
+        obj.save()
+        self.assertEqual(Person8.objects.search(query="changed").count(), 0)
+
+
+class TestInlineUpdate(TestCase):
+    def setUp(self):
+        Person3._fts_manager.auto_update_inline = True
+
+    def tearDown(self):
+        Person3._fts_manager.auto_update_inline = False
+        Person3.objects.filter(description=u"Inline").delete()
+
+    def test_inline_update(self):
+        obj = Person3.objects.create(name=u'Pèpâ', description=u"Inline")
+        self.assertEqual(Person3.objects.search(query="pepa inline").count(), 1)
+
+        obj.name = u'Andréi'
+        obj.save()
+        self.assertEqual(Person3.objects.search(query="pepa inline").count(), 0)
+        self.assertEqual(Person3.objects.search(query="andrei inline").count(), 1)
+
+        obj.name = u'Francisco'
+        obj.save(update_fields=['name'])
+        self.assertEqual(Person3.objects.search(query="francisco inline").count(), 1)
+
+
+class TestSearchTrigger(TestCase):
+    def skipUnlessDjango17(self):
+        if django.VERSION < (1, 7):
+            self.skipTest("Requires Django>=1.7")
+
+    def setUp(self):
+        self.skipUnlessDjango17()
+
+        from django.db import connection
+        from djorm_pgfulltext.operations import CreateSearchTrigger
+
+        self.operation = CreateSearchTrigger('Person2', fields=(('name', 'A'), ('description', 'B')),
+                                             config='names', name='person2_search')
+        with connection.schema_editor() as editor:
+            self.operation.database_forwards('djorm_pgfulltext', editor, None, None)
+
+    def tearDown(self):
+        from django.db import connection
+
+        with connection.schema_editor() as editor:
+            self.operation.database_backwards('djorm_pgfulltext', editor, None, None)
+        Person2.objects.filter(description=u"Triggered").delete()
+
+    def test_trigger(self):
+        obj = Person2.objects.create(name=u'Alfa', description=u"Triggered")
+        self.assertEqual(Person2.objects.search(query="alfa triggered").count(), 1)
+
+        Person2.objects.filter(pk=obj.pk).update(name=u'Bravo')
+        self.assertEqual(Person2.objects.search(query="alfa triggered").count(), 0)
+        self.assertEqual(Person2.objects.search(query="bravo triggered").count(), 1)
+
+        Person2.objects.filter(pk=obj.pk).update(search_index='')
+        self.assertEqual(Person2.objects.search(query="bravo triggered").count(), 1)
+
+    def test_trigger_name(self):
+        from django.db import connection
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT tgname FROM pg_trigger WHERE tgrelid = 'djorm_pgfulltext_person2'::regclass "
+                       "AND NOT tgisinternal ORDER BY tgname")
+        self.assertEqual([x[0] for x in cursor.fetchall()], ['person2_search_insert', 'person2_search_update'])
+
+
+class TestGeneratedVectorField(TestCase):
+    def setUp(self):
+        from django.db import connection
+
+        if django.VERSION < (1, 7):
+            self.skipTest("Requires Django>=1.7")
+        if connection.pg_version < 120000:
+            self.skipTest("Requires PostgreSQL>=12")
+
+        with connection.schema_editor() as editor:
+            editor.create_model(Person6)
+
+    def tearDown(self):
+        from django.db import connection
+
+        with connection.schema_editor() as editor:
+            editor.delete_model(Person6)
+
+    def test_generated_vector_field(self):
+        obj = Person6.objects.create(name=u'Pèpâ', description=u"Is a housewife")
+        self.assertEqual(Person6.objects.search(query="pepa housewife").count(), 1)
+
+        obj.name = u'Andréi'
+        obj.save()
+        self.assertEqual(Person6.objects.search(query="andrei housewife").count(), 1)
+
+        Person6.objects.filter(pk=obj.pk).update(name=u'Francisco')
+        self.assertEqual(Person6.objects.search(query="francisco housewife").count(), 1)
+        self.assertEqual(Person6.objects.update_search_field(), (0, 0))
+
+
+class TestSearchIndex(TestCase):
+    def setUp(self):
+        if django.VERSION < (1, 7):
+            self.skipTest("Requires Django>=1.7")
+
+    def get_index_definition(self):
+        from django.db import connection
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s",
+                       ['djorm_pgfulltext_person2_search_index_gin'])
+        row = cursor.fetchone()
+        return row and row[0]
+
+    def test_search_index_sql(self):
+        from django.db import connection
+        from djorm_pgfulltext.fields import VectorField
+
+        field = VectorField(fastupdate=False, gin_pending_list_limit=1024)
+        field.set_attributes_from_name('search_index')
+        field.model = Person2
+
+        self.assertEqual(
+            field.get_search_index_sql(connection, concurrently=True),
+            'CREATE INDEX CONCURRENTLY "djorm_pgfulltext_person2_search_index_gin" ON "djorm_pgfulltext_person2" '
+            'USING gin ("search_index") WITH (fastupdate = off, gin_pending_list_limit = 1024);'
+        )
+        self.assertEqual(field.deconstruct()[3], {'fastupdate': False, 'gin_pending_list_limit': 1024})
+        self.assertRaises(ValueError, VectorField, index_type='gist', fastupdate=True)
+
+    def test_create_search_index(self):
+        import warnings
+        from django.apps import apps
+        from django.db import connection
+        from django.db.migrations.state import ProjectState
+        from djorm_pgfulltext.operations import CreateSearchIndex
+
+        state = ProjectState.from_apps(apps)
+        operation = CreateSearchIndex('Person2', 'search_index')
+
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            with connection.schema_editor() as editor:
+                operation.database_forwards('djorm_pgfulltext', editor, state, state)
+            self.assertIn('USING gin (search_index)', self.get_index_definition())
+
+            with connection.schema_editor() as editor:
+                operation.database_backwards('djorm_pgfulltext', editor, state, state)
+            self.assertEqual(self.get_index_definition(), None)
+
+    def test_search_expression_index_name(self):
+        import hashlib
+
+        manager = Person._fts_manager
+        self.assertEqual(
+            manager.get_drop_search_expression_index_sql(fields=('name',), config='names', using='default'),
+            'DROP INDEX IF EXISTS "djorm_pgfulltext_person_name_%s";' % hashlib.md5(b'name:|names').hexdigest()[:8]
+        )
+        self.assertEqual(manager.get_drop_search_expression_index_sql(name='person_name_fts'),
+                         'DROP INDEX IF EXISTS "person_name_fts";')
+
+    def test_create_search_expression_index(self):
+        import warnings
+        from django.db import connection
+        from djorm_pgfulltext.operations import CreateSearchExpressionIndex
+
+        operation = CreateSearchExpressionIndex('Person', fields=('name',), name='person_name_fts')
+
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            with connection.schema_editor() as editor:
+                operation.database_forwards('djorm_pgfulltext', editor, None, None)
+
+            try:
+                sql, params = Person.objects.search(query="Andrei", fields=('name',)).query.sql_with_params()
+                cursor = connection.cursor()
+                cursor.execute("SET enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql, params)
+                plan = "\n".join(x[0] for x in cursor.fetchall())
+                cursor.execute("RESET enable_seqscan")
+
+                self.assertIn("Index Scan on person_name_fts", plan)
+            finally:
+                with connection.schema_editor() as editor:
+                    operation.database_backwards('djorm_pgfulltext', editor, None, None)
+
+
+class TestPreparedSearch(FtsSetUpMixin, TestCase):
+    def get_prepared_statements(self):
+        from django.db import connection
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE name LIKE 'fts\\_%%'")
+        return set(x[0] for x in cursor.fetchall())
+
+    def test_prepared(self):
+        qs = Person.objects.search(query="Andrei", rank_field='rank')
+
+        results = list(qs.prepared())
+        self.assertEqual([x.pk for x in results], [self.p1.pk])
+        self.assertEqual(results[0].name, self.p1.name)
+        self.assertEqual(results[0].rank, list(qs)[0].rank)
+
+        statements = self.get_prepared_statements()
+        self.assertEqual(len(statements), 1)
+
+        results = list(Person.objects.search(query=u"Pèpâ", rank_field='rank').prepared())
+        self.assertEqual([x.pk for x in results], [self.p2.pk])
+        self.assertEqual(self.get_prepared_statements(), statements)
+
+    def test_prepared_limit(self):
+        from django.test.utils import override_settings
+
+        with override_settings(PGFULLTEXT_PREPARED_STATEMENTS=1):
+            list(Person.objects.search(query="Andrei").prepared())
+            list(Person.objects.search(query="Andrei", rank_field='rank').prepared())
+
+        self.assertEqual(len(self.get_prepared_statements()), 1)
+
+
+class TestSearchTop(TestCase):
+    def setUp(self):
+        Person2.objects.all().delete()
+        for name, description in ((u'Andréi', u'Python programmer'),
+                                  (u'Pèpâ', u'Python and django programmer'),
+                                  (u'Python', u'Programmer'),
+                                  (u'Juan', u'Is a housewife')):
+            Person2.objects.create(name=name, description=description)
+        Person2.objects.update_search_field()
+
+    def test_search_top(self):
+        expected = [(x.pk, x.rank) for x in Person2.objects.search('python', rank_field='rank')[:2]]
+
+        results = Person2.objects.search_top('python', limit=2)
+        self.assertEqual([(x.pk, x.rank) for x in results], expected)
+        self.assertEqual(results[0].name, u'Python')
+
+    def test_search_top_candidates(self):
+        results = Person2.objects.filter(description__contains='programmer').search_top(
+            'python', limit=1, candidates=1
+        )
+        self.assertEqual(len(results), 1)
+        self.assertNotEqual(results[0].name, u'Python')
+
+    def test_search_top_rum(self):
+        sql = str(Person2.objects.search_top('python', rum=True).query)
+        self.assertIn('<=>', sql)
+        self.assertNotIn('<=>', str(Person2.objects.search_top('python').query))
+
+        with self.assertRaises(ValueError):
+            Person2.objects.search_top('python', fields=('name',), rum=True)
+
+
+class TestEstimatedCount(TestCase):
+    def setUp(self):
+        Person2.objects.all().delete()
+        for number in range(30):
+            Person2.objects.create(name=u'Person %d' % number, description=u'Python programmer')
+        Person2.objects.create(name=u'Juan', description=u'Is a housewife')
+        Person2.objects.update_search_field()
+
+    def test_estimated_count(self):
+        qs = Person2.objects.search('python', rank_field='rank')
+        self.assertEqual(qs.estimated_count(), 30)
+        self.assertEqual(qs[:10].estimated_count(), 10)
+        self.assertEqual(Person2.objects.none().estimated_count(), 0)
+
+        # Over max_exact, the planner estimate is used.
+        count = qs.estimated_count(max_exact=5)
+        self.assertTrue(count > 5)
+
+    def test_search_paginator(self):
+        from djorm_pgfulltext.paginator import SearchPaginator
+
+        paginator = SearchPaginator(Person2.objects.search('python', rank_field='rank'), 10)
+        self.assertEqual(paginator.count, 30)
+        self.assertEqual(paginator.num_pages, 3)
+        self.assertEqual(len(paginator.page(3).object_list), 10)
+
+        self.assertEqual(SearchPaginator([1, 2, 3], 2).num_pages, 2)
+
+    def test_search_paginator_low_estimate(self):
+        from django.core.paginator import EmptyPage
+        from djorm_pgfulltext.paginator import SearchPaginator
+
+        paginator = SearchPaginator(Person2.objects.search('python', rank_field='rank'), 10, orphans=2)
+        paginator._estimated_count = 4
+
+        self.assertEqual(paginator.num_pages, 1)
+        page = paginator.page(1)
+        self.assertEqual((len(page.object_list), page.has_next(), page.end_index()), (10, True, 10))
+
+        page = paginator.page(page.next_page_number())
+        self.assertEqual(len(page.object_list), 10)
+        page = paginator.page(3)
+        self.assertEqual((len(page.object_list), page.has_next(), page.end_index()), (10, False, 30))
+
+        with self.assertRaises(EmptyPage):
+            paginator.page(4)
+
+
+class TestSearchCache(TestCase):
+    def setUp(self):
+        Person3._fts_manager.cache_timeout = 60
+        self.p1 = Person3.objects.create(name=u'Andréi', description=u"Cached python programmer")
+        self.p2 = Person3.objects.create(name=u'Pèpâ', description=u"Cached python")
+
+    def tearDown(self):
+        Person3._fts_manager.cache_timeout = None
+        Person3.objects.filter(description__startswith=u"Cached").delete()
+
+    def test_search_cache(self):
+        expected = [(x.pk, x.rank) for x in Person3.objects.search(query="cached python", rank_field='rank')]
+
+        results = Person3.objects.search(query="cached python", rank_field='rank', cache=True)
+        self.assertEqual([(x.pk, x.rank) for x in results], expected)
+
+        # Changing the rows behind the cache's back is not seen.
+        Person3.objects.filter(pk=self.p2.pk).update(search_index='')
+        results = Person3.objects.search(query=" Cached  PYTHON", rank_field='rank', cache=True)
+        self.assertEqual([(x.pk, x.rank) for x in results], expected)
+
+        # Updating the search field invalidates the cache.
+        self.p2.description = u"Cached python again"
+        self.p2.save()
+        results = Person3.objects.search(query="cached python", rank_field='rank', cache=True)
+        self.assertEqual(len(results), 2)
+
+        Person3.objects.filter(pk=self.p2.pk).update(search_index='')
+        Person3.objects.update_search_field(pk=self.p1.pk)
+        results = Person3.objects.search(query="cached python", cache=True)
+        self.assertEqual([x.pk for x in results], [self.p1.pk])
+
+    def test_search_cache_disabled(self):
+        with self.assertRaises(ValueError):
+            Person.objects.search(query="python", cache=True)
+
+
+class TestTsqueryCache(FtsSetUpMixin, TestCase):
+    def test_tsquery_cache(self):
+        from django.test.utils import override_settings
+        from djorm_pgfulltext.utils import _tsqueries
+
+        with override_settings(PGFULLTEXT_TSQUERY_CACHE_SIZE=2):
+            qs = Person.objects.search(query="Python programmer", rank_field='rank')
+            self.assertIn('::tsquery', str(qs.query))
+            self.assertEqual([x.pk for x in qs], [self.p1.pk])
+            self.assertEqual(list(_tsqueries.values())[-1], "'python' & 'programmer'")
+
+            # The headlines parse the query text, not the cached tsquery.
+            qs = Person.objects.search(query="Python programmer", headline_field='headline',
+                                       headline_document='description')
+            self.assertEqual(qs[0].headline, '<b>Python</b> <b>programmer</b>')
+            self.assertEqual([x[3] for x in _tsqueries][-1], "Python programmer")
+            self.assertNotIn("'python' & 'programmer'", [x[3] for x in _tsqueries])
+
+            for query in ("Pèpâ", "Andréi", "Pèpâ"):
+                self.assertEqual(Person.objects.search(query=query).count(), 1)
+            self.assertEqual([x[3] for x in _tsqueries], ["Andréi", "Pèpâ"])
+
+            if django.VERSION >= (1, 7):
+                from django.db import connection
+                from django.test.utils import CaptureQueriesContext
+                from djorm_pgfulltext.fields import TSConfig
+
+                qs = Person.objects.filter(search_index__ft_startswith=[TSConfig('names'), 'progra'])
+                self.assertEqual([x.pk for x in qs], [self.p1.pk])
+
+                # Found by the lookup and its words, before they are quoted.
+                self.assertEqual(list(_tsqueries)[-1][2:], ('names', ('ft_startswith', 'progra')))
+                self.assertEqual(list(_tsqueries.values())[-1], "'progra':*")
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual([x.pk for x in qs.all()], [self.p1.pk])
+                self.assertEqual(len(queries.captured_queries), 1)
+
+
+class TestSearchVectorCache(TestCase):
+    def test_search_vector_cache(self):
+        manager = Person2._fts_manager
+        key = (Person2, 'names', 'default', (('name', 'A'), ('description', 'B')), None)
+
+        # Compiled when the model class was prepared, and used by the updates.
+        self.assertIn(key, manager._search_vectors)
+        self.assertEqual(manager._get_search_vector('names', 'default'), manager._search_vectors[key])
+        vectors = len(manager._search_vectors)
+        Person2.objects.create(name=u'Cached', description=u'Vector').update_search_field()
+        Person2.objects.update_search_field(fields=manager._fields)
+        self.assertEqual(len(manager._search_vectors), vectors)
+
+        search_vector = manager._get_search_vector('names', 'default', fields=['name'])
+        self.assertIn((Person2, 'names', 'default', ('name',), None), manager._search_vectors)
+        self.assertEqual(search_vector, manager._compile_search_vector('names', 'default', fields=['name']))
+
+        # Not for models with their own converter.
+        from djorm_pgfulltext.models import prepare_search_vector_handler
+        Person4._fts_manager._search_vectors.clear()
+        prepare_search_vector_handler(Person4)
+        self.assertEqual(Person4._fts_manager._search_vectors, {})
+
+    def test_search_vector_order(self):
+        manager = Person2._fts_manager
+        self.assertEqual(manager._parse_fields(['description', 'name', 'description']),
+                         (('description', None), ('name', None)))
+        self.assertEqual(manager._parse_fields(None), (('name', None), ('description', None)))
+
+        search_vector = manager._compile_search_vector('names', 'default')
+        self.assertTrue(search_vector.index('"name"') < search_vector.index('"description"'))
+
+
+class TestRankOptions(TestCase):
+    def setUp(self):
+        Person2.objects.all().delete()
+        self.p1 = Person2.objects.create(name=u'Python', description=u'Programmer')
+        self.p2 = Person2.objects.create(name=u'Andréi', description=u'Python programmer', boost=10)
+        Person2.objects.update_search_field()
+
+    def search(self, **kwargs):
+        return [x.pk for x in Person2.objects.search('python', rank_field='rank', **kwargs)]
+
+    def test_rank_weights(self):
+        self.assertEqual(self.search(), [self.p1.pk, self.p2.pk])
+        self.assertEqual(self.search(rank_weights={'A': 0.1, 'B': 1.0}), [self.p2.pk, self.p1.pk])
+        self.assertEqual(self.search(rank_weights=[0.1, 0.2, 1.0, 0.1], rank_function='ts_rank_cd'),
+                         [self.p2.pk, self.p1.pk])
+
+        with self.assertRaises(ValueError):
+            self.search(rank_weights=[1.0])
+
+    def test_rank_boost_field(self):
+        self.assertEqual(self.search(rank_boost_field='boost'), [self.p2.pk, self.p1.pk])
+
+        Person2._fts_manager.rank_boost_field = 'boost'
+        try:
+            self.assertEqual(self.search(), [self.p2.pk, self.p1.pk])
+            results = Person2.objects.search_top('python', limit=1)
+            self.assertEqual([x.pk for x in results], [self.p2.pk])
+        finally:
+            Person2._fts_manager.rank_boost_field = None
+
+
+class TestLazyHeadline(FtsSetUpMixin, TestCase):
+    def test_lazy_headline(self):
+        qs = Person.objects.search(query='Python', rank_field='rank', headline_field='headline',
+                                   headline_document='description', lazy_headline=True)
+        self.assertNotIn('ts_headline', str(qs.query))
+
+        results = list(qs.all()[:1])
+        self.assertEqual(results[0].headline, '<b>Python</b> programmer')
+        self.assertEqual(list(qs.values_list('pk', flat=True)), [self.p1.pk])
+
+    def test_headline_options(self):
+        results = Person.objects.filter(pk=self.p1.pk).with_headlines(
+            'headline', 'description', 'Python', options={'StartSel': '[', 'StopSel': ']'}
+        )
+        self.assertEqual(results[0].headline, '[Python] programmer')
+
+        results = Person.objects.search(query='Python', headline_field='headline', headline_document='description',
+                                        headline_options='MaxWords=2, MinWords=1')
+        self.assertEqual(results[0].headline, '<b>Python</b>')
+
+
+class TestBulkUpdate(TestCase):
+    def tearDown(self):
+        Person3.objects.filter(description=u"Bulk").delete()
+
+    def test_bulk_create(self):
+        objs = Person3.objects.bulk_create([
+            Person3(name=u'Pèpâ', description=u"Bulk"),
+            Person3(name=u'Andréi', description=u"Bulk"),
+        ])
+        self.assertEqual(objs[0].search_index, '')
+        self.assertEqual(Person3.objects.search(query="pepa bulk").count(), 1)
+        self.assertEqual(Person3.objects.search(query="bulk").count(), 2)
+
+    def test_update(self):
+        Person3.objects.bulk_create([Person3(name=u'Pèpâ', description=u"Bulk")])
+
+        self.assertEqual(Person3.objects.filter(name=u'Pèpâ').update(name=u'Andréi'), 1)
+        self.assertEqual(Person3.objects.search(query="pepa bulk").count(), 0)
+        self.assertEqual(Person3.objects.search(query="andrei bulk").count(), 1)
+
+    def test_update_returning_keys(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        Person3.objects.bulk_create([Person3(name=u'Pèpâ', description=u"Bulk") for i in range(3)])
+
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                self.assertEqual(Person3.objects.filter(name=u'Pèpâ').update(name=u'Andréi'), 3)
+                for i in range(3):
+                    self.assertEqual(Person3.objects.filter(description=u"Bulk").update(name=u'Andréi %d' % i), 3)
+
+        # The keys come from the UPDATE itself, and no table is created.
+        self.assertEqual([x['sql'].split()[0] for x in queries.captured_queries if 'RELEASE' not in x['sql']
+                          and 'SAVEPOINT' not in x['sql']], ['UPDATE'] * 8)
+        self.assertEqual(Person3.objects.search(query="andrei bulk").count(), 3)
+
+        self.assertEqual(Person3.objects.filter(name=u'Nobody').update(name=u'Pèpâ'), 0)
+        self.assertEqual(Person3.objects.none().update(name=u'Pèpâ'), 0)
+
+    def test_bulk_update(self):
+        if not hasattr(Person3.objects.all(), 'bulk_update'):
+            self.skipTest("Requires Django>=2.2")
+
+        obj = Person3.objects.create(name=u'Pèpâ', description=u"Bulk")
+        obj.name = u'Andréi'
+        Person3.objects.bulk_update([obj], ['name'])
+        self.assertEqual(Person3.objects.search(query="andrei bulk").count(), 1)
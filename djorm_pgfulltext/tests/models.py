@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import json
+import uuid
 
 from django.db import models, connections
 
@@ -30,11 +31,14 @@ class Person2(models.Model):
     name = models.CharField(max_length=32)
     description = models.TextField()
     search_index = VectorField()
+    boost = models.FloatField(null=True)
+    modified = models.DateTimeField(auto_now=True, null=True)
 
     objects = SearchManager(
         fields=(('name', 'A'), ('description', 'B')),
         search_field = 'search_index',
         config = 'names',
+        modified_field = 'modified',
     )
 
     def __unicode__(self):
@@ -132,3 +136,56 @@ class Book(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class Person6(models.Model):
+    name = models.CharField(max_length=32)
+    description = models.TextField()
+    search_index = VectorField(generated=True)
+
+    objects = SearchManager(
+        fields=(('name', 'A'), ('description', 'B')),
+        search_field = 'search_index',
+        config = 'names',
+    )
+
+    class Meta:
+        # Generated columns need PostgreSQL >= 12, the table is created by the tests.
+        managed = False
+
+    def __unicode__(self):
+        return self.name
+
+
+class Person7(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    name = models.CharField(max_length=32)
+    description = models.TextField()
+    search_index = VectorField()
+
+    objects = SearchManager(
+        fields=(('name', 'A'), ('description', 'B')),
+        search_field = 'search_index',
+        config = 'names',
+    )
+
+    def __unicode__(self):
+        return self.name
+
+
+class Person8(models.Model):
+    name = models.CharField(max_length=32)
+    description = models.TextField()
+    visits = models.IntegerField(default=0)
+    search_index = VectorField()
+
+    objects = SearchManager(
+        fields=('name', 'description'),
+        search_field = 'search_index',
+        auto_update_search_field = True,
+        track_field_changes = True,
+        config = 'names'
+    )
+
+    def __unicode__(self):
+        return self.name
@@ -1,6 +1,11 @@
+from collections import OrderedDict
+import threading
+
 import psycopg2
+from psycopg2.extensions import ISQLQuote, encodings
 
-from django.db import connection
+from django.conf import settings
+from django.db import connection, connections
 from django.utils.text import force_text
 
 
@@ -8,3 +13,87 @@ def adapt(text):
     a = psycopg2.extensions.adapt(force_text(text))
     a.prepare(connection.connection)
     return a
+
+
+class InlineSQL(object):
+    """
+    A piece of SQL with its own parameters that, given as a query parameter,
+    is written as is into the query by psycopg2. It allows saving an SQL
+    expression in a model field.
+    """
+
+    def __init__(self, sql, params=()):
+        self.sql = sql
+        self.params = params
+        self.conn = None
+
+    def __conform__(self, protocol):
+        if protocol is ISQLQuote:
+            return self
+
+    def prepare(self, conn):
+        self.conn = conn
+
+    def getquoted(self):
+        encoding = encodings[self.conn.encoding] if self.conn is not None else 'utf-8'
+
+        chunks = self.sql.split('%s')
+        quoted = [chunks[0].encode(encoding)]
+        for param, chunk in zip(self.params, chunks[1:]):
+            a = psycopg2.extensions.adapt(param)
+            if self.conn is not None and hasattr(a, 'prepare'):
+                a.prepare(self.conn)
+            quoted.append(a.getquoted())
+            quoted.append(chunk.encode(encoding))
+
+        return b''.join(quoted)
+
+    def __str__(self):
+        return self.sql
+
+
+_tsqueries = OrderedDict()
+_tsqueries_lock = threading.Lock()
+
+
+def get_tsquery_cache_size():
+    return getattr(settings, 'PGFULLTEXT_TSQUERY_CACHE_SIZE', 0)
+
+
+def get_normalized_tsquery(function, config, query, using, key=None):
+    """
+    Return the text of the tsquery built by function(config, query), or
+    function(query) with the default config if config is None, where the
+    function is to_tsquery or plainto_tsquery. It is computed by the database
+    of `using` once and then remembered, for the
+    settings.PGFULLTEXT_TSQUERY_CACHE_SIZE most recently used queries.
+
+    A `key` identifies the query in place of its text, and query can then be
+    a callable building the text, only called when the query is not known.
+
+    The remembered queries are not updated if the text search configuration
+    or its dictionaries change.
+    """
+    key = (using, function, config, query if key is None else key)
+    with _tsqueries_lock:
+        tsquery = _tsqueries.pop(key, None)
+        if tsquery is not None:
+            _tsqueries[key] = tsquery
+            return tsquery
+
+    if callable(query):
+        query = query()
+
+    cursor = connections[using].cursor()
+    if config is None:
+        cursor.execute("SELECT %s(%%s)::text" % function, [query])
+    else:
+        cursor.execute("SELECT %s(%%s::regconfig, %%s)::text" % function, [config, query])
+    tsquery = cursor.fetchone()[0]
+
+    with _tsqueries_lock:
+        _tsqueries[key] = tsquery
+        while len(_tsqueries) > get_tsquery_cache_size():
+            _tsqueries.popitem(last=False)
+
+    return tsquery
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the Python overhead of building the search vector SQL of a save
+with automatic update, and of a search made with fields, with and without
+the compiled SQL kept by the manager. No database query is run.
+
+    python benchmark.py [number]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+if django.VERSION >= (1, 7):
+    django.setup()
+
+from djorm_pgfulltext.tests.models import Person2  # noqa
+
+
+class Uncached(dict):
+    """
+    A search vector cache never keeping anything, so every call compiles
+    the SQL again as it was done before it was cached.
+    """
+
+    def __setitem__(self, key, value):
+        pass
+
+
+def save_vector():
+    manager = Person2._fts_manager
+    manager._get_search_vector(manager.config, 'default', fields=manager._fields)
+
+
+def inline_save_vector(instance=Person2(name=u'Andréi', description=u'Python programmer')):
+    Person2._fts_manager._get_inline_search_vector(instance)
+
+
+def search_with_fields():
+    Person2.objects.search('python programmer', fields=('name', 'description'), rank_field='rank')
+
+
+def uncached(function):
+    def run():
+        Person2._fts_manager._inline_search_vector = None
+        function()
+    return run
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    manager = Person2._fts_manager
+
+    print("%-20s %12s %12s" % ("", "uncached", "cached"))
+    for function in (save_vector, inline_save_vector, search_with_fields):
+        search_vectors, manager._search_vectors = manager._search_vectors, Uncached()
+        try:
+            before = min(timeit.repeat(uncached(function), number=number, repeat=5))
+        finally:
+            manager._search_vectors = search_vectors
+        after = min(timeit.repeat(function, number=number, repeat=5))
+
+        print("%-20s %9.2f us %9.2f us" % (function.__name__, before / number * 1e6, after / number * 1e6))